@@ -0,0 +1,120 @@
+"""
+Step 2 请求构建的性能基准
+
+运行方式：
+>>> python benchmark_step2.py 控制图路径 [--images 100] [--server http://127.0.0.1:7860]
+
+比较旧版（原图 base64 嵌入每个 payload 并逐次序列化）与 ControlImage
+（缩放到 IP-Adapter 尺寸、只序列化一次）的每张图片请求大小与耗时。
+指定 --server 时还会实际发送请求并测量往返时间（会在服务器上生成图片）。
+"""
+
+import argparse
+import json
+import time
+
+import requests
+
+from step2_txt_to_image_webui import ControlImage, _encode_image_to_base64, build_payload, get_session
+
+DEFAULT_PARAMS = {
+    "width": 512,
+    "height": 512,
+    "steps": 20,
+    "sampler_name": "DPM++ 3M SDE",
+    "scheduler": "Karras",
+    "batch_size": 1,
+    "cfg_scale": 7,
+    "seed": -1,
+    "enable_hr": False,
+    "hr_scale": 2,
+    "hr_upscaler": "Latent",
+    "denoising_strength": 0.7,
+}
+
+
+def make_task(idx, control_image):
+    return {
+        "idx": idx,
+        "prompt": f"1girl, forest, apple BREAK scene {idx}",
+        "regional_counts": 1,
+        "params": DEFAULT_PARAMS,
+        "negative_prompt": "worst quality, low quality",
+        "control_image": control_image,
+    }
+
+
+def legacy_body(task, encoded_control_img):
+    """旧版：完整 base64 放入 payload，由 requests 的 json= 逐次序列化"""
+    payload = build_payload(task)
+    payload["alwayson_scripts"]["controlnet"]["args"][0]["image"] = encoded_control_img
+    return json.dumps(payload).encode("utf-8")
+
+
+def benchmark_serialization(control_path, images):
+    """比较每张图片的请求体大小与构建耗时"""
+    start = time.perf_counter()
+    encoded = _encode_image_to_base64(control_path)
+    legacy_setup = time.perf_counter() - start
+    start = time.perf_counter()
+    control = ControlImage(control_path)
+    control_setup = time.perf_counter() - start
+
+    rows = []
+    for name, setup, build in (
+        ("原图嵌入", legacy_setup, lambda i: legacy_body(make_task(i, control), encoded)),
+        ("ControlImage", control_setup, lambda i: control.serialize(build_payload(make_task(i, control)))),
+    ):
+        start = time.perf_counter()
+        sizes = [len(build(i)) for i in range(images)]
+        elapsed = time.perf_counter() - start
+        rows.append((name, setup, sizes[0], elapsed / images))
+
+    print(f"请求构建（{images} 张图片，参考图缩放至 {control.size[0]}x{control.size[1]}）")
+    print("| 方式 | 预处理 (ms) | 单个请求 (KiB) | 单张序列化 (ms) |")
+    print("| --- | ---: | ---: | ---: |")
+    for name, setup, size, per_image in rows:
+        print(f"| {name} | {setup * 1000:.1f} | {size / 1024:.0f} | {per_image * 1000:.2f} |")
+    return encoded, control
+
+
+def benchmark_requests(server_url, encoded, control, images):
+    """向服务器实际发送请求，比较每张图片的往返时间"""
+    session = get_session(server_url)
+    print(f"请求往返（{server_url}，每种方式 {images} 张）")
+    print("| 方式 | 平均往返 (s) |")
+    print("| --- | ---: |")
+    for name, build in (
+        ("原图嵌入", lambda i: legacy_body(make_task(i, control), encoded)),
+        ("ControlImage", lambda i: control.serialize(build_payload(make_task(i, control)))),
+    ):
+        start = time.perf_counter()
+        for i in range(images):
+            resp = session.post(
+                f"{server_url}/sdapi/v1/txt2img",
+                data=build(i),
+                headers={"Content-Type": "application/json"},
+                timeout=(5, 600),
+            )
+            resp.raise_for_status()
+        print(f"| {name} | {(time.perf_counter() - start) / images:.2f} |")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Step 2 请求构建性能基准")
+    parser.add_argument("control_image", help="控制图路径")
+    parser.add_argument("--images", type=int, default=100, help="模拟的图片数量")
+    parser.add_argument("--server", default=None, help="可选：实际发送请求的 WebUI 服务器")
+    parser.add_argument("--requests", type=int, default=3, help="实际发送的请求数")
+    args = parser.parse_args()
+
+    encoded, control = benchmark_serialization(args.control_image, args.images)
+    if args.server:
+        try:
+            benchmark_requests(args.server.rstrip("/"), encoded, control, args.requests)
+        except requests.RequestException as exc:
+            print(f"请求失败: {exc}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Step 3 语音合成的性能基准
+
+运行方式：
+>>> python benchmark_step3.py [--novel Demo/白雪公主.txt] [--scenes 16] [--workers 1 2 4 8]
+
+以 Demo 小说的每一行作为一个场景，需要 voice/Kokoro-82M-v1.1-zh 模型文件。
+"""
+
+import argparse
+import glob
+import os
+import re
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from sentence_splitter import split_clauses, split_sentences
+from step3_txt_to_voice_kokoro import assemble_audio, convert_text_to_audio
+
+CURRENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_NOVEL = os.path.join(CURRENT_DIR, 'Demo', '白雪公主.txt')
+
+
+def load_demo_scenes(path, max_scenes=None):
+    """读取 Demo 小说，每个非空行作为一个场景并按句末标点切分为句子"""
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if max_scenes:
+        lines = lines[:max_scenes]
+    scenes = []
+    for line in lines:
+        sentences = [s for s in re.findall(r'[^。！？]+[。！？]?', line) if s.strip()]
+        if sentences:
+            scenes.append(tuple(sentences))
+    return scenes
+
+
+def benchmark_workers(tasks, worker_counts, gender='zf'):
+    """比较不同进程数下的合成耗时"""
+    baseline = None
+    print(f"多进程合成（{len(tasks)} 个场景，{sum(len(t) for t in tasks)} 个句子）")
+    print("| 进程数 | 耗时 (s) | 加速比 |")
+    print("| ---: | ---: | ---: |")
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory() as output_dir:
+            start = time.perf_counter()
+            convert_text_to_audio(tasks, 'zh', output_dir, gender, workers=workers)
+            elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(f"| {workers} | {elapsed:.1f} | {baseline / elapsed:.2f}x |")
+
+
+def _legacy_assemble(chunks, leading_silence):
+    """旧版逐句 np.concatenate 的拼接方式"""
+    wavs_para = []
+    for i, wav in enumerate(chunks):
+        if i == 0 and leading_silence > 0:
+            wav = np.concatenate([np.zeros(leading_silence), wav])
+        if i == 0:
+            wavs_para = wav
+        else:
+            wavs_para = np.concatenate([wavs_para, wav])
+    return wavs_para
+
+
+def benchmark_audio_assembly(tasks, sample_rate=24000, seconds_per_char=0.2, silence=10000):
+    """用与 Demo 小说句长相当的模拟音频，比较两种段落拼接方式的耗时与峰值内存"""
+    rng = np.random.default_rng(0)
+    paragraphs = [
+        [rng.standard_normal(int(len(s) * seconds_per_char * sample_rate)).astype(np.float32) for s in task]
+        for task in tasks
+    ]
+
+    print(f"段落音频拼接（{len(tasks)} 个场景，{sum(len(t) for t in tasks)} 个句子）")
+    print("| 方式 | 耗时 (s) | 峰值内存 (MiB) |")
+    print("| --- | ---: | ---: |")
+    for name, assemble in (('np.concatenate', _legacy_assemble), ('预分配缓冲区', assemble_audio)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        wavs = [assemble(chunks, silence if index > 0 else 0) for index, chunks in enumerate(paragraphs)]
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del wavs
+        print(f"| {name} | {elapsed:.2f} | {peak / 2**20:.1f} |")
+
+
+def _legacy_split_sentences(scenario):
+    """旧版 process_text_files 中基于占位符替换的分句"""
+    quotes = re.findall(r'“([^”]*[。！？])”', scenario)
+    temp_scenario = scenario
+    placeholders = {}
+    for i, quote in enumerate(quotes):
+        placeholder = f"__QUOTE_{i}__"
+        placeholders[placeholder] = quote
+        temp_scenario = temp_scenario.replace(f'“{quote}”', placeholder)
+
+    sentences = re.split(r'([。！？.!?])', temp_scenario)
+    processed_sentences = []
+    for i in range(0, len(sentences), 2):
+        s = sentences[i].strip()
+        if s:
+            if i + 1 < len(sentences) and sentences[i + 1]:
+                s += sentences[i + 1]
+            for placeholder, quote in placeholders.items():
+                s = s.replace(placeholder, f'“{quote}”')
+            processed_sentences.append(s)
+    return processed_sentences
+
+
+def _legacy_split_clauses(text, quote_chars='“”'):
+    """旧版 step4 中逐字符拼接的 smart_split_text"""
+    parts = []
+    current_part = ""
+    in_quotes = False
+    for char in text:
+        if char in quote_chars:
+            in_quotes = not in_quotes
+            current_part += char
+        elif in_quotes:
+            current_part += char
+        elif char in ['，', ',', '。', '！', '？', '；', ';']:
+            current_part += char
+            if current_part.strip():
+                parts.append(current_part.strip())
+            current_part = ""
+        else:
+            current_part += char
+    if current_part.strip():
+        parts.append(current_part.strip())
+    return parts
+
+
+def benchmark_sentence_splitting(novel_paths, repeat=20):
+    """在 Demo 小说上比较新旧分句实现的耗时，并校验结果一致"""
+    texts = []
+    for path in novel_paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            texts.extend(line.strip() for line in f if line.strip())
+
+    print(f"分句（{len(novel_paths)} 部小说，{len(texts)} 段，重复 {repeat} 次）")
+    print("| 实现 | 旧版 (ms) | 新版 (ms) | 结果一致 |")
+    print("| --- | ---: | ---: | --- |")
+    for name, legacy, current in (
+        ('split_sentences', _legacy_split_sentences, split_sentences),
+        ('split_clauses', _legacy_split_clauses, split_clauses),
+    ):
+        timings = []
+        for func in (legacy, current):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                results = [func(text) for text in texts]
+            timings.append((time.perf_counter() - start) * 1000)
+        same = all(legacy(text) == current(text) for text in texts)
+        print(f"| {name} | {timings[0]:.1f} | {timings[1]:.1f} | {'是' if same else '否'} |")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Step 3 性能基准")
+    parser.add_argument('--novel', default=DEFAULT_NOVEL, help="用于测试的小说文本")
+    parser.add_argument('--scenes', type=int, default=16, help="最多使用的场景数")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help="要测试的进程数")
+    parser.add_argument('--skip-tts', action='store_true', help="只运行不需要模型的基准")
+    args = parser.parse_args()
+
+    benchmark_sentence_splitting(sorted(glob.glob(os.path.join(CURRENT_DIR, 'Demo', '*.txt'))))
+    benchmark_audio_assembly(load_demo_scenes(args.novel))
+    if not args.skip_tts:
+        tasks = load_demo_scenes(args.novel, args.scenes)
+        benchmark_workers(tasks, args.workers)
+
+
+if __name__ == "__main__":
+    main()
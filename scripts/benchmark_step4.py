@@ -0,0 +1,182 @@
+"""
+Step 4 视频合成的性能基准
+
+运行方式：
+>>> python benchmark_step4.py [图片路径]
+
+未指定图片时使用 image/ 下的第一张图片，若不存在则使用随机生成的 1024x1024 图片。
+"""
+
+import argparse
+import glob
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from moviepy.editor import VideoFileClip
+
+from step4_output_video import (
+    KenBurnsRenderer,
+    SegmentFrameSource,
+    create_subtitle_image,
+    get_config,
+    get_export_profile,
+    render_subtitle_tile,
+    transform_image,
+    write_videofile_args,
+)
+
+CURRENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_benchmark_image(path=None):
+    """加载基准测试所用的图片"""
+    if path is None:
+        candidates = sorted(glob.glob(os.path.join(CURRENT_DIR, 'image', 'output_*.png')))
+        path = candidates[0] if candidates else None
+    if path and os.path.exists(path):
+        return Image.open(path).convert('RGB')
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, (1024, 1024, 3), dtype=np.uint8))
+
+
+def benchmark_ken_burns(im, seconds=5, fps=20):
+    """比较 transform_image 与 KenBurnsRenderer 的逐帧生成速度（帧/秒）"""
+    segment_frames = int(seconds * fps)
+    x_speed = (im.width - im.width * 0.8) / seconds
+
+    start = time.perf_counter()
+    for t in range(segment_frames):
+        np.array(transform_image(im, t / fps, x_speed, 0, True, True))
+    legacy_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    renderer = KenBurnsRenderer(im)
+    windows = renderer.crop_windows(segment_frames, fps, x_speed, 0, True, True)
+    for frame in renderer.frames(windows):
+        np.ascontiguousarray(frame)
+    renderer_elapsed = time.perf_counter() - start
+
+    print(f"Ken Burns 平移 ({im.width}x{im.height}, {segment_frames} 帧)")
+    print(f"  transform_image : {segment_frames / legacy_elapsed:8.1f} 帧/秒")
+    print(f"  KenBurnsRenderer: {segment_frames / renderer_elapsed:8.1f} 帧/秒")
+
+
+def benchmark_segment_memory(im, seconds=10, fps=20):
+    """比较整段帧列表与按需合成两种方式的峰值内存"""
+    segment_frames = int(seconds * fps)
+    x_speed = (im.width - im.width * 0.8) / seconds
+    background = np.asarray(im.filter(ImageFilter.GaussianBlur(radius=30)).resize(
+        (int(im.width * 1.1), int(im.height * 1.1)), Image.Resampling.LANCZOS))
+
+    tracemalloc.start()
+    frames_foreground = [
+        np.array(transform_image(im, t / fps, x_speed, 0, True, True))
+        for t in range(segment_frames)
+    ]
+    frames_background = [np.array(background)] * segment_frames
+    _, legacy_peak = tracemalloc.get_traced_memory()
+    del frames_foreground, frames_background
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    renderer = KenBurnsRenderer(im)
+    windows = renderer.crop_windows(segment_frames, fps, x_speed, 0, True, True)
+    source = SegmentFrameSource(renderer, windows, background, [], fps)
+    for i in range(segment_frames):
+        source.make_frame(i / fps)
+    _, streaming_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"片段峰值内存 ({im.width}x{im.height}, {segment_frames} 帧)")
+    print(f"  帧列表  : {legacy_peak / 2**20:8.1f} MiB")
+    print(f"  按需合成: {streaming_peak / 2**20:8.1f} MiB")
+
+
+def benchmark_subtitle_composite(im, seconds=5, fps=20, text="白雪公主咬下了那只红彤彤的毒苹果"):
+    """比较整帧 RGBA 字幕图层与字幕贴片两种合成方式的吞吐量"""
+    segment_frames = int(seconds * fps)
+    background = np.asarray(im)
+    height, width = background.shape[:2]
+
+    full_frame = create_subtitle_image(text, width, height)
+    start = time.perf_counter()
+    for _ in range(segment_frames):
+        alpha = full_frame[..., 3:4].astype(np.float32) / 255
+        (full_frame[..., :3] * alpha + background * (1 - alpha)).astype(np.uint8)
+    full_frame_elapsed = time.perf_counter() - start
+
+    renderer = KenBurnsRenderer(im, crop_ratio=1)
+    windows = np.zeros((segment_frames, 2), dtype=np.intp)
+    tile, position = render_subtitle_tile(text, width, height)
+    source = SegmentFrameSource(renderer, windows, background, [(tile, position, 0, seconds)], fps)
+    empty = SegmentFrameSource(renderer, windows, background, [], fps)
+    start = time.perf_counter()
+    for i in range(segment_frames):
+        source.make_frame(i / fps)
+    sprite_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(segment_frames):
+        empty.make_frame(i / fps)
+    # 扣除前景、背景合成本身的耗时，只比较字幕混合
+    sprite_elapsed -= time.perf_counter() - start
+
+    print(f"字幕合成 ({width}x{height}, 贴片 {tile.shape[1]}x{tile.shape[0]}, {segment_frames} 帧)")
+    print(f"  整帧图层: {segment_frames / full_frame_elapsed:8.1f} 帧/秒")
+    print(f"  字幕贴片: {segment_frames / max(sprite_elapsed, 1e-9):8.1f} 帧/秒")
+
+
+def benchmark_encode_profiles(im, seconds=5, fps=20, clip_path=None):
+    """按 config.json 中的每个导出配置编码同一段视频，输出耗时与文件大小表格"""
+    config = get_config()
+    if clip_path is None:
+        candidate = os.path.join(CURRENT_DIR, 'temp', 'output_0.mp4')
+        clip_path = candidate if os.path.exists(candidate) else None
+
+    if clip_path:
+        clip = VideoFileClip(clip_path)
+        source_name = os.path.basename(clip_path)
+    else:
+        segment_frames = int(seconds * fps)
+        renderer = KenBurnsRenderer(im)
+        windows = renderer.crop_windows(segment_frames, fps, (im.width * 0.2) / seconds, 0, True, True)
+        clip = SegmentFrameSource(renderer, windows, np.asarray(im), [], fps).to_clip()
+        source_name = f"合成片段 {seconds}s"
+
+    profile_names = list({**config.get('export_profiles', {}), 'intermediate': None, 'delivery': None})
+    print(f"编码配置对比（{source_name}）")
+    print("| 配置 | 编码耗时 (s) | 文件大小 (MiB) |")
+    print("| --- | ---: | ---: |")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in profile_names:
+            output = os.path.join(tmp_dir, f'{name}.mp4')
+            start = time.perf_counter()
+            clip.write_videofile(output, fps=fps, logger=None, **write_videofile_args(get_export_profile(config, name), clip.size))
+            elapsed = time.perf_counter() - start
+            print(f"| {name} | {elapsed:.2f} | {os.path.getsize(output) / 2**20:.2f} |")
+    clip.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Step 4 性能基准")
+    parser.add_argument('image', nargs='?', default=None, help="用于测试的图片路径")
+    parser.add_argument('--seconds', type=float, default=5, help="模拟的片段时长（秒）")
+    parser.add_argument('--fps', type=int, default=20, help="帧率")
+    parser.add_argument('--clip', default=None, help="用于编码对比的视频（默认 temp/output_0.mp4）")
+    parser.add_argument('--encode', action='store_true', help="同时运行编码配置对比")
+    args = parser.parse_args()
+
+    im = load_benchmark_image(args.image)
+    benchmark_ken_burns(im, args.seconds, args.fps)
+    benchmark_segment_memory(im, args.seconds, args.fps)
+    benchmark_subtitle_composite(im, args.seconds, args.fps)
+    if args.encode:
+        benchmark_encode_profiles(im, args.seconds, args.fps, args.clip)
+
+
+if __name__ == "__main__":
+    main()
@@ -48,11 +48,13 @@ def run_all_steps(novel_text, api_key, server_urls_text, max_workers, min_senten
     if "失败" in result1:
         return "\n".join(results)
     
-    # Step 2 (多服务器)
-    result2, _ = gradio_utils.step2.run_step2(
+    # Step 2 (多服务器)，run_step2 是生成器，取最后一次产出的状态
+    result2 = ""
+    for result2, _ in gradio_utils.step2.run_step2(
         server_urls_text, max_workers, width, height, steps, "DPM++ 3M SDE", 
         "Karras", 7, -1, True, 2, "Latent", 0.7, "", "", None
-    )
+    ):
+        pass
     results.append(f"Step 2: {result2}")
     
     if "失败" in result2:
@@ -179,6 +181,10 @@ with gr.Blocks(title="BADAPPLE", theme=gr.themes.Soft()) as demo:
             """)
 
 if __name__ == "__main__":
+    # 后台预热语音模型，设置 PREWARM_TTS=0 可关闭
+    if os.getenv("PREWARM_TTS", "1") == "1":
+        gradio_utils.step3.prewarm()
+
     demo.launch(
         server_name="0.0.0.0",
         server_port=7870,
@@ -1,6 +1,7 @@
 import gradio as gr
 import os
 import json
+import time
 from pathlib import Path
 import sys
 
@@ -10,7 +11,8 @@ scripts_dir = project_dir / "scripts"
 sys.path.append(str(scripts_dir))
 
 from step2_txt_to_image_webui import (
-    run_webui_program, 
+    iter_webui_program,
+    BatchProgress,
     get_generated_images, 
     regenerate_images,
     set_server_urls,
@@ -36,10 +38,17 @@ def test_servers(server_urls_text):
     
     return result
 
+# 生成过程中刷新状态与画廊的最小间隔（秒）
+GALLERY_REFRESH_INTERVAL = 2
+
 def run_step2(server_urls_text, max_workers, width, height, steps, sampler, scheduler, 
               cfg_scale, seed, enable_hr, hr_scale, hr_upscaler, denoising_strength, 
-              more_details, negative_prompt, control_image):
-    """执行 Step 2: 文本转图像（多服务器版本）"""
+              more_details, negative_prompt, control_image, per_server_concurrency=1):
+    """执行 Step 2: 文本转图像（多服务器版本）
+
+    生成器：定期产出 (状态, 画廊)，状态包含预计剩余时间与各服务器利用率，
+    画廊随生成进度逐步填充。
+    """
     try:
         # 设置服务器列表
         if server_urls_text.strip():
@@ -85,18 +94,40 @@ def run_step2(server_urls_text, max_workers, width, height, steps, sampler, sche
             control_image.save(control_path)
             control_path = str(control_path)
         
-        # 执行生成（并行）
-        run_webui_program(
+        # 执行生成（并行），图片完成后逐步刷新展示
+        images = 0
+        latest = None
+        batch = None
+        shown = 0
+        last_refresh = 0.0
+        for event in iter_webui_program(
             extra_params=extra_params,
             control_image=control_path,
-            max_workers=max_workers
-        )
+            max_workers=int(max_workers) if max_workers else None,
+            per_server_concurrency=int(per_server_concurrency or 1),
+            heartbeat=GALLERY_REFRESH_INTERVAL
+        ):
+            if isinstance(event, BatchProgress):
+                batch = event
+            elif event is not None:
+                images += 1
+                latest = event[0]
+            now = time.monotonic()
+            if now - last_refresh >= GALLERY_REFRESH_INTERVAL:
+                last_refresh = now
+                status = f"⏳ 已生成 {images} 张图片" + (f"（最新: output_{latest}.png）" if latest else "")
+                if batch:
+                    status += "\n" + batch.describe()
+                # 没有新图片时只刷新状态
+                gallery = update_image_gallery() if images != shown else gr.update()
+                shown = images
+                yield status, gallery
         
         # 刷新图片展示
-        return "✅ Step 2 完成：图像生成完成", update_image_gallery()
+        yield "✅ Step 2 完成：图像生成完成", update_image_gallery()
         
     except Exception as e:
-        return f"❌ Step 2 失败: {str(e)}", gr.update()
+        yield f"❌ Step 2 失败: {str(e)}", gr.update()
 
 def update_image_gallery():
     """更新图片画廊"""
@@ -191,7 +222,13 @@ def create_interface():
                     step2_max_workers = gr.Number(
                         label="最大并行数",
                         value=len(SERVER_URLS),
-                        info="建议不超过服务器数量"
+                        info="所有服务器合计的同时请求数"
+                    )
+                    step2_per_server = gr.Number(
+                        label="每个服务器并发数",
+                        value=1,
+                        precision=0,
+                        info="空闲的服务器会自动领取下一张图片"
                     )
                     
                     server_status = gr.Textbox(
@@ -241,7 +278,7 @@ def create_interface():
 
                 
                 step2_btn = gr.Button("🎨 开始并行生成", variant="primary", size="lg")
-                step2_output = gr.Textbox(label="执行结果", lines=3)
+                step2_output = gr.Textbox(label="执行结果", lines=6)
             
             # 右侧：图片展示和重绘
             with gr.Column(scale=2):
@@ -292,7 +329,7 @@ def create_interface():
                 step2_server_urls, step2_max_workers, step2_width, step2_height, step2_steps, 
                 step2_sampler, step2_scheduler, step2_cfg, step2_seed, step2_enable_hr, 
                 step2_hr_scale, step2_hr_upscaler, step2_denoising, step2_more_details, 
-                step2_negative, step2_control_image
+                step2_negative, step2_control_image, step2_per_server
             ],
             outputs=[step2_output, image_gallery]
         )
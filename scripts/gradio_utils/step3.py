@@ -10,18 +10,26 @@ sys.path.append(str(project_dir))
 sys.path.append(str(scripts_dir))
 
 try:
-    from step3_txt_to_voice_kokoro import main as step3_main
+    from step3_txt_to_voice_kokoro import main as step3_main, prewarm_speech_provider
 except ImportError as e:
     print(f"导入 step3_txt_to_voice_kokoro 失败: {e}")
 
-def run_step3(language, gender):
+def prewarm(language="zh", gender="zf"):
+    """后台预加载默认音色的语音模型，减少首次点击的等待"""
+    try:
+        return prewarm_speech_provider(gender, language)
+    except Exception as e:
+        print(f"语音模型预热失败: {e}")
+        return None
+
+def run_step3(language, gender, workers=1):
     """执行 Step 3: 文本转语音"""
     try:
         # 使用固定的路径
         input_file = str(project_dir / "scripts" / "场景分割.json")
         output_dir = str(project_dir / "voice")
         
-        success, audio_files = step3_main(input_file, output_dir, language, gender)
+        success, audio_files = step3_main(input_file, output_dir, language, gender, workers=int(workers))
         
         if success and audio_files:
             # 返回第一个音频文件用于预览，以及所有文件的信息
@@ -96,6 +104,14 @@ def create_interface():
                     choices=[("女声", "zf"), ("男声", "zm")],
                     value="zf"
                 )
+                step3_workers = gr.Slider(
+                    label="并行进程数",
+                    minimum=1,
+                    maximum=os.cpu_count() or 1,
+                    value=1,
+                    step=1,
+                    info="按场景分配到多个进程合成，每个进程单独加载模型"
+                )
                 
                 with gr.Row():
                     step3_btn = gr.Button("🎤 生成语音", variant="primary")
@@ -136,7 +152,7 @@ def create_interface():
         # 生成语音按钮的回调
         step3_btn.click(
             fn=run_step3,
-            inputs=[step3_language, step3_gender],
+            inputs=[step3_language, step3_gender, step3_workers],
             outputs=[step3_output, step3_audio_preview, step3_audio_files]
         ).then(
             fn=lambda files: [
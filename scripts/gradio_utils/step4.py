@@ -11,8 +11,9 @@ sys.path.append(str(project_dir))
 sys.path.append(str(scripts_dir))
 
 try:
-    from step4_output_video import main as step4_main
+    from step4_output_video import main as step4_main, DEFAULT_EXPORT_PROFILES
 except ImportError as e:
+    DEFAULT_EXPORT_PROFILES = {"intermediate": {}, "delivery": {}}
     print(f"导入 step4_output_video 失败: {e}")
 
 def get_config():
@@ -23,7 +24,12 @@ def get_config():
             return json.load(f)
     return {}
 
-def update_config(fps, enlarge_background, enable_effect, effect_type):
+def get_export_profile_names():
+    """获取可选的导出配置名称"""
+    return list({**DEFAULT_EXPORT_PROFILES, **get_config().get("export_profiles", {})})
+
+def update_config(fps, enlarge_background, enable_effect, effect_type, render_workers=1,
+                  intermediate_profile="delivery", delivery_profile="delivery"):
     """更新配置文件"""
     try:
         config_file = project_dir / 'config.json'
@@ -40,7 +46,10 @@ def update_config(fps, enlarge_background, enable_effect, effect_type):
             "fps": fps,
             "enlarge_background": enlarge_background,
             "enable_effect": enable_effect,
-            "effect_type": effect_type
+            "effect_type": effect_type,
+            "render_workers": int(render_workers),
+            "intermediate_profile": intermediate_profile,
+            "delivery_profile": delivery_profile
         })
         
         # 保存配置
@@ -52,11 +61,13 @@ def update_config(fps, enlarge_background, enable_effect, effect_type):
         print(f"更新配置失败: {e}")
         return False
 
-def run_step4(fps, enlarge_background, enable_effect, effect_type):
+def run_step4(fps, enlarge_background, enable_effect, effect_type, render_workers=1,
+              intermediate_profile="delivery", delivery_profile="delivery"):
     """执行 Step 4: 输出视频"""
     try:
         # 更新配置
-        if not update_config(fps, enlarge_background, enable_effect, effect_type):
+        if not update_config(fps, enlarge_background, enable_effect, effect_type, render_workers,
+                             intermediate_profile, delivery_profile):
             return "❌ Step 4 失败: 无法更新配置文件", None
         
         # 检查必要的输入文件
@@ -205,6 +216,27 @@ def create_interface():
                     ],
                     value="fade"
                 )
+                step4_workers = gr.Slider(
+                    label="并行渲染进程数",
+                    minimum=1,
+                    maximum=os.cpu_count() or 1,
+                    value=get_config().get("render_workers", 1),
+                    step=1,
+                    info="多个场景同时渲染，建议不超过 CPU 核心数"
+                )
+                with gr.Row():
+                    step4_intermediate_profile = gr.Dropdown(
+                        label="场景视频编码配置",
+                        choices=get_export_profile_names(),
+                        value=get_config().get("intermediate_profile", "delivery"),
+                        info="intermediate 为快速无损编码"
+                    )
+                    step4_delivery_profile = gr.Dropdown(
+                        label="最终视频编码配置",
+                        choices=get_export_profile_names(),
+                        value=get_config().get("delivery_profile", "delivery"),
+                        info="与场景配置相同时直接拼接，不再重新编码"
+                    )
                 
                 with gr.Row():
                     step4_btn = gr.Button("🎬 生成视频", variant="primary")
@@ -251,7 +283,8 @@ def create_interface():
         # 生成视频按钮的回调
         step4_btn.click(
             fn=run_step4,
-            inputs=[step4_fps, step4_enlarge, step4_enable_effect, step4_effect_type],
+            inputs=[step4_fps, step4_enlarge, step4_enable_effect, step4_effect_type, step4_workers,
+                    step4_intermediate_profile, step4_delivery_profile],
             outputs=[step4_output, step4_video_preview]
         ).then(
             fn=load_existing_videos,
@@ -304,7 +337,13 @@ def create_interface():
             outputs=[step4_video_preview, step4_current_file]
         )
 
-def run_step4_for_all(fps=30, enlarge_background=True, enable_effect=True, effect_type="fade"):
+def run_step4_for_all(fps=30, enlarge_background=True, enable_effect=True, effect_type="fade", render_workers=None):
     """供一键生成调用的简化版本"""
-    result, video_path = run_step4(fps, enlarge_background, enable_effect, effect_type)
+    config = get_config()
+    if render_workers is None:
+        render_workers = config.get("render_workers", 1)
+    result, video_path = run_step4(
+        fps, enlarge_background, enable_effect, effect_type, render_workers,
+        config.get("intermediate_profile", "delivery"), config.get("delivery_profile", "delivery")
+    )
     return result
\ No newline at end of file
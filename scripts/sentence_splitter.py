@@ -0,0 +1,65 @@
+"""
+Step 3 配音与 Step 4 字幕共用的分句工具
+
+所有正则在模块加载时编译，分句均为单次扫描。
+"""
+
+import re
+from functools import lru_cache
+
+# 以句末标点结尾的整段引语，内部不再切分
+_PROTECTED_QUOTE = re.compile(r'“[^”]*[。！？]”')
+_SENTENCE_END = re.compile(r'[。！？.!?]')
+
+CLAUSE_PUNCTUATION = '，,。！？；;'
+CURLY_QUOTES = '“”'
+
+
+def split_sentences(text):
+    """按句末标点切分句子，标点保留在句尾，以句末标点结尾的引语整体保留"""
+    protected = [m.span() for m in _PROTECTED_QUOTE.finditer(text)]
+    sentences = []
+    start = 0
+    quote = 0
+    for m in _SENTENCE_END.finditer(text):
+        position = m.start()
+        while quote < len(protected) and protected[quote][1] <= position:
+            quote += 1
+        if quote < len(protected) and protected[quote][0] <= position:
+            continue
+        sentence = text[start:position].strip()
+        # 与 re.split 的行为一致：空片段连同其后的标点一起丢弃
+        if sentence:
+            sentences.append(sentence + m.group())
+        start = m.end()
+
+    tail = text[start:].strip()
+    if tail:
+        sentences.append(tail)
+    return sentences
+
+
+@lru_cache(maxsize=8)
+def _clause_pattern(quote_chars):
+    return re.compile(f"[{re.escape(quote_chars + CLAUSE_PUNCTUATION)}]")
+
+
+def split_clauses(text, quote_chars=CURLY_QUOTES):
+    """按逗号、句号等标点切分短句，引号内的内容不切分"""
+    parts = []
+    start = 0
+    in_quotes = False
+    for m in _clause_pattern(quote_chars).finditer(text):
+        char = m.group()
+        if char in quote_chars:
+            in_quotes = not in_quotes
+        elif not in_quotes:
+            part = text[start:m.end()].strip()
+            if part:
+                parts.append(part)
+            start = m.end()
+
+    tail = text[start:].strip()
+    if tail:
+        parts.append(tail)
+    return parts
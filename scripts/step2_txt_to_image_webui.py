@@ -8,7 +8,8 @@
 1. **移除** 了所有 ComfyUI 专用依赖与工作流构建代码；
 2. **保留** 了原有的中文注释、终端输出与交互逻辑；
 3. 仍然通过读取 ``txt/txt2.xlsx`` 第 **C** 列的非空单元格来获取提示词，
-   生成的 PNG 将保存到 ``image/``；参数日志以 JSONL 形式写入 ``temp/params.jsonl``。
+   生成的 PNG 将保存到 ``image/``；每张图片的参数与各阶段耗时以 JSONL 形式写入
+   ``temp/step2_metrics.jsonl``。
 
 运行方式：
 >>> python generate_images_webui.py
@@ -19,22 +20,39 @@
 
 from __future__ import annotations
 
+import asyncio
 import base64
+import hashlib
+import io
 import json
 import logging
 import os
+import shutil
+import ssl
 import random
+import heapq
+import statistics
 import sys
-from typing import Any, Optional
+import time
+from typing import Any, Callable, Iterator, Optional
 import concurrent.futures
 import threading
-from queue import Queue
+from queue import Empty, Queue
 
 import openpyxl  # pip install openpyxl
 import requests  # pip install requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm  # pip install tqdm
 
+try:
+    import httpx  # pip install httpx（可选，用于 asyncio 引擎）
+    # httpx 默认以 INFO 级别记录每个请求
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+except ImportError:
+    httpx = None
+
 import glob
+from datetime import datetime
 from PIL import Image
 
 # ---------------------------------------------------------------------------
@@ -69,15 +87,24 @@ else:
 CURRENT_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 PROMPT_XLSX: str = os.path.join(CURRENT_DIR, "txt", "output.xlsx")
 IMAGE_DIR: str = os.path.join(CURRENT_DIR, "image")
-PARAMS_LOG: str = os.path.join(CURRENT_DIR, "temp", "params.jsonl")
+METRICS_LOG: str = os.path.join(CURRENT_DIR, "temp", "step2_metrics.jsonl")
+TIMINGS_FILE: str = os.path.join(CURRENT_DIR, "temp", "step2_timings.json")
+IMAGE_CACHE_DIR: str = os.path.join(CURRENT_DIR, "temp", "step2_cache")
+IMAGE_CACHE_MAX_BYTES: int = 2 << 30
 print(CURRENT_DIR)
 # 创建必要目录
 os.makedirs(IMAGE_DIR, exist_ok=True)
-os.makedirs(os.path.dirname(PARAMS_LOG), exist_ok=True)
+os.makedirs(os.path.dirname(METRICS_LOG), exist_ok=True)
 
 # 线程安全的日志写入锁
 log_lock = threading.Lock()
 
+# HTTP 超时（连接, 读取），单位秒
+TXT2IMG_TIMEOUT: tuple[float, float] = (5, 600)
+STATUS_TIMEOUT: tuple[float, float] = (3, 5)
+# 每个服务器保持的 keep-alive 连接数下限，调度器会按每服务器并发数扩大
+HTTP_POOL_MAXSIZE: int = 8
+
 # ---------------------------------------------------------------------------
 # Excel 工具函数
 # ---------------------------------------------------------------------------
@@ -106,39 +133,530 @@ def _encode_image_to_base64(path: str) -> str:
         return base64.b64encode(f.read()).decode("utf-8")
 
 
-def txt2img(payload: dict[str, Any], server_url: str) -> bytes:
-    """调用指定WebUI服务器的txt2img接口并返回第一张图片的二进制数据。"""
+# IP-Adapter 的 CLIP 视觉编码器以 224×224 输入，更大的参考图只会增加上传量
+IP_ADAPTER_SHORT_SIDE: int = 224
+
+
+class ControlImage:
+    """ControlNet（IP-Adapter）参考图。
+
+    按 IP-Adapter 实际使用的尺寸缩小后只编码、序列化一次；payload 中以占位符引用，
+    发送前直接拼接预先序列化好的字节串，日志中只记录图片哈希。
+    """
+
+    PLACEHOLDER = "__CONTROL_IMAGE__"
+
+    def __init__(self, path: str, short_side: int = IP_ADAPTER_SHORT_SIDE) -> None:
+        im = Image.open(path).convert("RGB")
+        scale = short_side / min(im.size)
+        if scale < 1:
+            im = im.resize((round(im.width * scale), round(im.height * scale)), Image.Resampling.LANCZOS)
+        buf = io.BytesIO()
+        im.save(buf, format="PNG")
+        png = buf.getvalue()
+
+        self.size = im.size
+        self.original_bytes = os.path.getsize(path)
+        self.base64 = base64.b64encode(png).decode("ascii")
+        self.sha256 = hashlib.sha256(png).hexdigest()
+        self._placeholder_json = json.dumps(self.PLACEHOLDER).encode("ascii")
+        self._image_json = json.dumps(self.base64).encode("ascii")
+
+    @property
+    def reference(self) -> str:
+        """日志中代替 base64 的引用"""
+        return f"sha256:{self.sha256}"
+
+    def serialize(self, payload: dict[str, Any]) -> bytes:
+        """序列化 payload，并把占位符替换为预先序列化的参考图"""
+        body = json.dumps(payload).encode("utf-8")
+        return body.replace(self._placeholder_json, self._image_json, 1)
+
+
+# 每个服务器一个 Session，在所有工作线程间共享 keep-alive 连接
+_sessions: dict[str, requests.Session] = {}
+_pool_sizes: dict[str, int] = {}
+_sessions_lock = threading.Lock()
+
+def get_session(server_url: str, pool_maxsize: int | None = None) -> requests.Session:
+    """获取指定服务器的 HTTP 会话（连接池）
+
+    pool_maxsize 大于当前连接池时重新挂载更大的连接池，避免并发请求超过连接池后丢弃 keep-alive 连接。
+    """
+    pool_maxsize = max(HTTP_POOL_MAXSIZE, pool_maxsize or 0)
+    with _sessions_lock:
+        session = _sessions.get(server_url)
+        if session is None:
+            session = _sessions[server_url] = requests.Session()
+        if _pool_sizes.get(server_url, 0) < pool_maxsize:
+            # 失败重试由调度器负责，这里不做自动重试
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+            session.mount(server_url, adapter)
+            _pool_sizes[server_url] = pool_maxsize
+        return session
+
+
+def txt2img(payload: dict[str, Any] | bytes, server_url: str) -> bytes:
+    """调用指定WebUI服务器的txt2img接口并返回第一张图片的二进制数据。
+
+    payload 可以是已经序列化好的 JSON 字节串，避免重复序列化。
+    """
     txt2img_url = f"{server_url}/sdapi/v1/txt2img"
-    resp = requests.post(txt2img_url, json=payload, timeout=600)
+    body = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+    resp = get_session(server_url).post(
+        txt2img_url,
+        data=body,
+        headers={"Content-Type": "application/json"},
+        timeout=TXT2IMG_TIMEOUT,
+    )
     resp.raise_for_status()
-    data = resp.json()
+    return decode_txt2img_response(resp.content, server_url)
+
+def decode_txt2img_response(content: bytes, server_url: str) -> bytes:
+    """解析 txt2img 的响应，返回第一张图片的二进制数据"""
+    data = json.loads(content)
     if not data.get("images"):
         raise RuntimeError(f"WebUI服务器 {server_url} 未返回任何图像！")
     return base64.b64decode(data["images"][0])
 
+def get_server_checkpoint(server_url: str) -> Optional[str]:
+    """读取服务器当前加载的模型（sd_model_checkpoint），失败时返回 None"""
+    try:
+        resp = get_session(server_url).get(f"{server_url}/sdapi/v1/options", timeout=STATUS_TIMEOUT)
+        resp.raise_for_status()
+        return json.loads(resp.content).get("sd_model_checkpoint")
+    except (requests.RequestException, ValueError):
+        return None
+
 def get_server_status(server_url: str) -> bool:
     """检查WebUI服务器状态"""
     try:
-        resp = requests.get(f"{server_url}/sdapi/v1/memory", timeout=5)
+        resp = get_session(server_url).get(f"{server_url}/sdapi/v1/memory", timeout=STATUS_TIMEOUT)
         return resp.status_code == 200
-    except:
+    except requests.RequestException:
         return False
 
 def get_available_servers() -> list[str]:
-    """获取可用的WebUI服务器列表"""
+    """并发检查所有服务器，返回可用的WebUI服务器列表"""
+    if not SERVER_URLS:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(SERVER_URLS)) as executor:
+        statuses = list(executor.map(get_server_status, SERVER_URLS))
+
     available = []
-    for server in SERVER_URLS:
-        if get_server_status(server):
+    for server, ok in zip(SERVER_URLS, statuses):
+        if ok:
             available.append(server)
             logging.info(f"服务器可用: {server}")
         else:
             logging.warning(f"服务器不可用: {server}")
     return available
 
+# ---------------------------------------------------------------------------
+# 生成进度监控
+# ---------------------------------------------------------------------------
+
+class ProgressMonitor:
+    """后台并发轮询有在途请求的服务器的 ``/sdapi/v1/progress``，拆分每张图片的耗时。
+
+    WebUI 按到达顺序逐个执行生成任务，state.job_timestamp 在每个任务开始时变化：
+    新出现的 job_timestamp 归属于该服务器最早发出、尚未开始的请求。
+    由此得到排队等待、采样、高分辨率修复（采样步数归零重新开始）与传输四段时间，
+    精度受轮询间隔限制。利用率为服务器有在途请求的时间占整批耗时的比例。
+    """
+
+    def __init__(self, servers: list[str], poll_interval: float = 1.0) -> None:
+        self.servers = servers
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._inflight: dict[str, list[dict]] = {server: [] for server in servers}
+        # 每个服务器最近一次的进度
+        self.snapshots: dict[str, dict[str, Any]] = {server: {} for server in servers}
+        # 每个服务器累计的忙碌时间，以及当前这段忙碌的开始时间（空闲时为 None）
+        self._busy: dict[str, float] = {server: 0.0 for server in servers}
+        self._busy_since: dict[str, float | None] = {server: None for server in servers}
+        self.started = time.monotonic()
+        self.stopped: float | None = None
+
+    def start(self) -> "ProgressMonitor":
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="webui-progress", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.stopped = time.monotonic()
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def begin(self, server_url: str) -> dict:
+        """记录请求发出，返回该请求的跟踪记录"""
+        trace = {"sent": time.monotonic(), "job": None, "sampling_start": None,
+                 "hires_start": None, "generation_end": None, "last_step": 0}
+        with self._lock:
+            if not self._inflight[server_url]:
+                self._busy_since[server_url] = trace["sent"]
+            self._inflight[server_url].append(trace)
+        return trace
+
+    def end(self, server_url: str, trace: dict) -> dict[str, Optional[float]]:
+        """记录收到响应，返回各阶段耗时（秒），未观察到的阶段为 None"""
+        received = time.monotonic()
+        with self._lock:
+            traces = self._inflight[server_url]
+            # 按对象身份移除，字段相同的两条记录不能混淆
+            del traces[next(i for i, t in enumerate(traces) if t is trace)]
+            if not traces:
+                self._busy[server_url] += received - self._busy_since[server_url]
+                self._busy_since[server_url] = None
+                self.snapshots[server_url] = {}
+        sampling_start = trace["sampling_start"]
+        generation_end = trace["generation_end"] or received
+        hires_start = trace["hires_start"]
+        return {
+            "queue_wait": sampling_start - trace["sent"] if sampling_start else None,
+            "sampling": (hires_start or generation_end) - sampling_start if sampling_start else None,
+            "hires": generation_end - hires_start if hires_start else None,
+            "transfer": received - trace["generation_end"] if trace["generation_end"] else None,
+            "total": received - trace["sent"],
+        }
+
+    def utilization(self, server_url: str) -> Optional[float]:
+        """服务器有在途请求的时间占整批耗时（从 start 到 stop 或当前）的比例"""
+        now = self.stopped or time.monotonic()
+        with self._lock:
+            busy = self._busy[server_url]
+            since = self._busy_since[server_url]
+        if since is not None:
+            busy += now - since
+        wall = now - self.started
+        return min(busy / wall, 1.0) if wall > 0 else None
+
+    def snapshot(self, server_url: str) -> dict[str, Any]:
+        """服务器最近一次的进度，没有在途请求时为空"""
+        with self._lock:
+            return self.snapshots[server_url] if self._inflight[server_url] else {}
+
+    def _run(self) -> None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.servers))) as executor:
+            while not self._stop.wait(self.poll_interval):
+                with self._lock:
+                    busy = [server for server, traces in self._inflight.items() if traces]
+                list(executor.map(self._poll, busy))
+
+    def _poll(self, server_url: str) -> None:
+        try:
+            resp = get_session(server_url).get(
+                f"{server_url}/sdapi/v1/progress",
+                params={"skip_current_image": "true"},
+                timeout=STATUS_TIMEOUT,
+            )
+            resp.raise_for_status()
+            data = json.loads(resp.content)
+        except (requests.RequestException, ValueError):
+            return
+
+        now = time.monotonic()
+        state = data.get("state") or {}
+        job = state.get("job_timestamp")
+        step = state.get("sampling_step") or 0
+        active = (state.get("job_count") or 0) > 0
+        with self._lock:
+            self.snapshots[server_url] = {
+                "active": active,
+                "progress": data.get("progress") or 0,
+                "eta": data.get("eta_relative") or 0,
+            }
+            for trace in self._inflight[server_url]:
+                if not active:
+                    # 服务器空闲：已开始的请求都已生成完毕，正在传输
+                    if trace["job"] and trace["generation_end"] is None:
+                        trace["generation_end"] = now
+                    continue
+                if trace["job"] == job:
+                    if step < trace["last_step"] and trace["hires_start"] is None:
+                        trace["hires_start"] = now
+                    trace["last_step"] = step
+                    break
+                if trace["job"] is None:
+                    trace.update(job=job, sampling_start=now, last_step=step)
+                    break
+                # 服务器已开始下一个任务，本请求的生成已经结束
+                if trace["generation_end"] is None:
+                    trace["generation_end"] = now
+
+
+class BatchProgress:
+    """一次批量生成的进度，供 Gradio 界面显示 ETA 与各服务器利用率
+
+    costs 为需要实际生成的图片的 {图片索引: 估计成本}，cached 为直接从缓存复制的图片数。
+    """
+
+    def __init__(
+        self,
+        costs: dict[int, float],
+        predicted: Optional[float],
+        monitor: ProgressMonitor,
+        cached: int = 0,
+    ) -> None:
+        self.costs = costs
+        self.total = len(costs) + cached
+        self.done = cached
+        self.predicted = predicted
+        self.monitor = monitor
+        self.started = time.monotonic()
+        self._finished_cost = 0.0
+        self._generated_cost = 0.0
+
+    def record(self, idx: int, success: bool) -> None:
+        """记录一张图片结束；失败的图片不计入生成速度"""
+        self.done += 1
+        self._finished_cost += self.costs[idx]
+        if success:
+            self._generated_cost += self.costs[idx]
+
+    def eta(self) -> Optional[float]:
+        """剩余时间（秒）：按已实际生成的图片成本估算速度，尚无生成完成的图片时使用预测耗时"""
+        elapsed = time.monotonic() - self.started
+        if self._generated_cost:
+            remaining = sum(self.costs.values()) - self._finished_cost
+            return elapsed / self._generated_cost * remaining
+        if self.predicted is not None:
+            return max(self.predicted - elapsed, 0.0)
+        return None
+
+    def describe(self) -> str:
+        eta = self.eta()
+        lines = [f"进度 {self.done}/{self.total}" + (f"，预计剩余 {eta:.0f}s" if eta is not None else "")]
+        for server in self.monitor.servers:
+            snapshot = self.monitor.snapshot(server)
+            utilization = self.monitor.utilization(server)
+            state = (
+                f"生成中 {snapshot['progress']:.0%}（当前图片剩余 {snapshot['eta']:.0f}s）"
+                if snapshot.get("active") else "空闲"
+            )
+            usage = f"利用率 {utilization:.0%}" if utilization is not None else "利用率 -"
+            lines.append(f"{server}  {usage}  {state}")
+        return "\n".join(lines)
+
+
+# ---------------------------------------------------------------------------
+# 图片缓存（固定种子时结果可复现）
+# ---------------------------------------------------------------------------
+
+class ImageCache:
+    """按完整请求内容寻址的图片缓存，保存在 temp/step2_cache/<哈希>.png
+
+    命中时更新文件修改时间，总大小超过上限时按修改时间淘汰最久未使用的文件。
+    """
+
+    def __init__(self, cache_dir: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_BYTES) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(entry.stat().st_size for entry in self._entries())
+
+    def _entries(self) -> list[os.DirEntry]:
+        return [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".png")]
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    @staticmethod
+    def make_key(payload: dict[str, Any], control_image: Optional[ControlImage], checkpoint: str) -> str:
+        """payload、参考图哈希与服务器模型共同决定缓存键"""
+        record = json.dumps(
+            [payload, control_image.reference if control_image else None, checkpoint],
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(record.encode("utf-8")).hexdigest()
+
+    def restore(self, keys: list[str], out_path: str) -> bool:
+        """任一缓存键命中时把图片复制到 out_path"""
+        for key in keys:
+            path = self._path(key)
+            try:
+                shutil.copyfile(path, out_path)
+                os.utime(path)
+            except OSError:
+                continue
+            with self._lock:
+                self.hits += 1
+            return True
+        with self._lock:
+            self.misses += 1
+        return False
+
+    def put(self, key: str, img_bytes: bytes) -> None:
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(img_bytes)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.total_bytes += len(img_bytes)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        """删除最久未使用的缓存，直到总大小降到上限的 90% 以下"""
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        self.total_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.total_bytes -= size
+            except FileNotFoundError:
+                continue
+
 # ---------------------------------------------------------------------------
 # 单个图片生成任务
 # ---------------------------------------------------------------------------
 
+def build_payload(task_info: dict) -> dict[str, Any]:
+    """构建 txt2img 请求的 payload，参考图以 ControlImage.PLACEHOLDER 占位"""
+    prompt_core = task_info["prompt"]
+    regional_counts = task_info["regional_counts"]
+    params = task_info["params"]
+    negative_prompt = task_info["negative_prompt"]
+    control_image = task_info["control_image"]
+
+    # 构建区域分割参数
+    regional_division = "1"
+    if regional_counts > 1:
+        regional_division += ",1" * (regional_counts - 1)
+
+    positive_prompt = f"{prompt_core}"
+
+    # 构建 payload
+    payload: dict[str, Any] = {
+        "prompt": positive_prompt,
+        "negative_prompt": negative_prompt,
+        **{k: params[k] for k in (
+            "width",
+            "height",
+            "steps",
+            "sampler_name",
+            "scheduler",
+            "batch_size",
+            "cfg_scale",
+            "seed",
+            "enable_hr",
+            "hr_scale",
+            "hr_upscaler",
+            "denoising_strength",
+        )},
+    }
+
+    if control_image:
+        payload.setdefault("alwayson_scripts", {}).update(
+            {
+                "controlnet": {
+                    "args": [
+                        {
+                            "enabled": True,
+                            "image": ControlImage.PLACEHOLDER,
+                            "module": "ip-adapter-auto",
+                            "model": "ip-adapter_sd15_plus [32cd8f7f]",
+                        }
+                    ]
+                },
+                "Regional Prompter": {
+                    "args": [
+                        True,                  # 1  Active
+                        False,                 # 2  debug
+                        "Matrix",              # 3  Mode
+                        "Vertical",            # 4  Mode (Matrix)
+                        "Mask",                # 5  Mode (Mask)
+                        "Prompt",              # 6  Mode (Prompt)
+                        regional_division,               # 7  Ratios
+                        "",                    # 8  Base Ratios
+                        False,                 # 9  Use Base
+                        False,                 # 10 Use Common
+                        False,                 # 11 Use Neg-Common
+                        "Attention",           # 12 Calcmode
+                        False,                 # 13 Not Change AND
+                        "0",                   # 14 LoRA Textencoder
+                        "0",                   # 15 LoRA U-Net
+                        "0",                   # 16 Threshold
+                        "",                    # 17 Mask (图片路径)
+                        "0",                   # 18 LoRA stop step
+                        "0",                   # 19 LoRA Hires stop step
+                        False                  # 20 flip
+                    ]
+                }
+            }
+        )
+
+    return payload
+
+
+def prepare_request(task_info: dict) -> tuple[dict[str, Any], bytes]:
+    """构建 payload 并序列化为请求体"""
+    control_image = task_info["control_image"]
+    payload = build_payload(task_info)
+    body = control_image.serialize(payload) if control_image else json.dumps(payload).encode("utf-8")
+    return payload, body
+
+
+def save_generated_image(
+    task_info: dict,
+    payload: dict[str, Any],
+    img_bytes: bytes,
+    server_url: str,
+    elapsed: float,
+    request_bytes: int,
+    phases: dict[str, Optional[float]] | None = None,
+) -> str:
+    """保存生成的图片、写入缓存并记录参数与各阶段耗时，返回图片路径"""
+    idx = task_info["idx"]
+    control_image = task_info["control_image"]
+
+    # 保存图片
+    out_name = f"output_{idx + 1}.png"
+    out_path = os.path.join(IMAGE_DIR, out_name)
+    with open(out_path, "wb") as f:
+        f.write(img_bytes)
+    
+    # 固定种子时按生成该图片的服务器模型写入缓存
+    image_cache = task_info.get("image_cache")
+    checkpoint = task_info.get("checkpoints", {}).get(server_url)
+    if image_cache and checkpoint:
+        image_cache.put(ImageCache.make_key(payload, control_image, checkpoint), img_bytes)
+    
+    # 线程安全地记录参数与各阶段耗时（参考图只记录哈希）
+    record = json.dumps({
+        "image": out_name,
+        "server": server_url,
+        "finished_at": datetime.now().isoformat(timespec="seconds"),
+        "request_bytes": request_bytes,
+        "elapsed": elapsed,
+        **(phases or {}),
+        "payload": payload,
+    }, ensure_ascii=False)
+    if control_image:
+        record = record.replace(json.dumps(ControlImage.PLACEHOLDER), json.dumps(control_image.reference))
+    with log_lock:
+        with open(METRICS_LOG, "a", encoding="utf-8") as fp:
+            fp.write(record + "\n")
+    
+    logging.info(
+        f"图片已保存 → {out_path} (服务器: {server_url}, "
+        f"请求 {request_bytes / 1024:.0f} KiB, 用时 {elapsed:.1f}s)"
+    )
+    return out_path
+
+
 def generate_single_image(task_info: dict) -> tuple[int, bool, str]:
     """生成单张图片的任务函数
     
@@ -149,97 +667,22 @@ def generate_single_image(task_info: dict) -> tuple[int, bool, str]:
         tuple: (索引, 是否成功, 错误信息)
     """
     idx = task_info["idx"]
-    prompt_core = task_info["prompt"]
-    regional_counts = task_info["regional_counts"]
-    params = task_info["params"]
-    negative_prompt = task_info["negative_prompt"]
-    encoded_control_img = task_info["encoded_control_img"]
     server_url = task_info["server_url"]
     
     try:
-        # 构建区域分割参数
-        regional_division = "1"
-        if regional_counts > 1:
-            regional_division += ",1" * (regional_counts - 1)
-        
-        positive_prompt = f"{prompt_core}"
-
-        # 构建 payload
-        payload: dict[str, Any] = {
-            "prompt": positive_prompt,
-            "negative_prompt": negative_prompt,
-            **{k: params[k] for k in (
-                "width",
-                "height",
-                "steps",
-                "sampler_name",
-                "scheduler",
-                "batch_size",
-                "cfg_scale",
-                "seed",
-                "enable_hr",
-                "hr_scale",
-                "hr_upscaler",
-                "denoising_strength",
-            )},
-        }
-
-        if encoded_control_img:
-            payload.setdefault("alwayson_scripts", {}).update(
-                {
-                    "controlnet": {
-                        "args": [
-                            {
-                                "enabled": True,
-                                "image": encoded_control_img,
-                                "module": "ip-adapter-auto",
-                                "model": "ip-adapter_sd15_plus [32cd8f7f]",
-                            }
-                        ]
-                    },
-                    "Regional Prompter": {
-                        "args": [
-                            True,                  # 1  Active
-                            False,                 # 2  debug
-                            "Matrix",              # 3  Mode
-                            "Vertical",            # 4  Mode (Matrix)
-                            "Mask",                # 5  Mode (Mask)
-                            "Prompt",              # 6  Mode (Prompt)
-                            regional_division,               # 7  Ratios
-                            "",                    # 8  Base Ratios
-                            False,                 # 9  Use Base
-                            False,                 # 10 Use Common
-                            False,                 # 11 Use Neg-Common
-                            "Attention",           # 12 Calcmode
-                            False,                 # 13 Not Change AND
-                            "0",                   # 14 LoRA Textencoder
-                            "0",                   # 15 LoRA U-Net
-                            "0",                   # 16 Threshold
-                            "",                    # 17 Mask (图片路径)
-                            "0",                   # 18 LoRA stop step
-                            "0",                   # 19 LoRA Hires stop step
-                            False                  # 20 flip
-                        ]
-                    }
-                }
-            )
+        payload, body = prepare_request(task_info)
 
         # 生成图片
-        img_bytes = txt2img(payload, server_url)
-        
-        # 保存图片
-        out_name = f"output_{idx + 1}.png"
-        out_path = os.path.join(IMAGE_DIR, out_name)
-        with open(out_path, "wb") as f:
-            f.write(img_bytes)
-        
-        # 线程安全地记录参数
-        with log_lock:
-            with open(PARAMS_LOG, "a", encoding="utf-8") as fp:
-                json.dump({out_name: payload}, fp, ensure_ascii=False)
-                fp.write("\n")
-        
-        logging.info(f"图片已保存 → {out_path} (服务器: {server_url})")
+        monitor = task_info.get("monitor")
+        trace = monitor.begin(server_url) if monitor else None
+        started = time.perf_counter()
+        try:
+            img_bytes = txt2img(body, server_url)
+        finally:
+            phases = monitor.end(server_url, trace) if monitor else None
+        elapsed = time.perf_counter() - started
+
+        save_generated_image(task_info, payload, img_bytes, server_url, elapsed, len(body), phases)
         return idx, True, ""
         
     except Exception as exc:
@@ -247,6 +690,478 @@ def generate_single_image(task_info: dict) -> tuple[int, bool, str]:
         logging.error(error_msg)
         return idx, False, str(exc)
 
+# ---------------------------------------------------------------------------
+# 任务成本估计（最长任务优先）
+# ---------------------------------------------------------------------------
+
+# 相对于无附加功能时的耗时增量
+REGION_COST_FACTOR: float = 0.15      # Regional Prompter 每多一个区域
+CONTROLNET_COST_FACTOR: float = 0.2   # ControlNet（IP-Adapter）
+
+
+def estimate_task_cost(task: dict) -> float:
+    """估计单个任务的相对成本，单位为 512×512 分辨率下的一个采样步。"""
+    params = task["params"]
+    pixel_factor = params["width"] * params["height"] / (512 * 512)
+    cost = pixel_factor * params["steps"]
+    if params.get("enable_hr"):
+        # 高分辨率修复的第二遍按放大后的面积与去噪强度折算
+        hr_steps = params.get("hr_second_pass_steps") or params["steps"]
+        cost += pixel_factor * params["hr_scale"] ** 2 * hr_steps * params["denoising_strength"]
+    if task.get("control_image"):
+        # 只有提供控制图时才会启用 ControlNet 与 Regional Prompter
+        cost *= 1 + CONTROLNET_COST_FACTOR + REGION_COST_FACTOR * task["regional_counts"]
+    return cost
+
+
+class ServerTimings:
+    """每个服务器每单位成本的耗时（秒），以指数滑动平均更新并跨运行保存。"""
+
+    def __init__(self, path: str = TIMINGS_FILE, alpha: float = 0.3) -> None:
+        self.path = path
+        self.alpha = alpha
+        self.seconds_per_unit: dict[str, float] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.seconds_per_unit = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                pass
+
+    def speed(self, server_url: str) -> Optional[float]:
+        """服务器的秒/单位成本；没有记录时使用其他服务器的中位数"""
+        if server_url in self.seconds_per_unit:
+            return self.seconds_per_unit[server_url]
+        if self.seconds_per_unit:
+            return statistics.median(self.seconds_per_unit.values())
+        return None
+
+    def update(self, server_url: str, cost: float, elapsed: float) -> None:
+        observed = elapsed / max(cost, 1e-6)
+        previous = self.seconds_per_unit.get(server_url)
+        self.seconds_per_unit[server_url] = (
+            observed if previous is None else previous + self.alpha * (observed - previous)
+        )
+
+    def save(self) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.seconds_per_unit, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def predict_makespan(
+        self,
+        costs: list[float],
+        servers: list[str],
+        per_server_concurrency: int = 1,
+        max_in_flight: int | None = None,
+    ) -> Optional[float]:
+        """模拟调度器的行为（最长任务优先，最先空闲的服务器领取下一个任务）估计整批耗时
+
+        max_in_flight 为所有服务器合计的在途请求上限，与调度器一致。没有历史记录时返回 None。
+        """
+        speeds = [self.speed(server) for server in servers]
+        if not costs or any(speed is None for speed in speeds):
+            return None
+        slots = [(0.0, k, speed) for k, speed in enumerate(speeds * per_server_concurrency)]
+        heapq.heapify(slots)
+        limit = max_in_flight or len(slots)
+        # 正在执行的任务的结束时间；达到上限时，下一个任务要等最早结束的任务让出名额
+        running: list[float] = []
+        finish = 0.0
+        for cost in sorted(costs, reverse=True):
+            free_at, k, speed = heapq.heappop(slots)
+            start = free_at
+            if len(running) >= limit:
+                start = max(start, heapq.heappop(running))
+            end = start + cost * speed
+            heapq.heappush(running, end)
+            heapq.heappush(slots, (end, k, speed))
+            finish = max(finish, end)
+        return finish
+
+# ---------------------------------------------------------------------------
+# 多服务器调度（共享队列 + 工作窃取）
+# ---------------------------------------------------------------------------
+
+class CircuitBreaker:
+    """单个服务器的熔断状态。
+
+    连续失败 failure_threshold 次后熔断，暂停向该服务器派发任务，
+    直到后台探测 ``/sdapi/v1/memory`` 成功后恢复。
+    """
+
+    def __init__(self, server_url: str, failure_threshold: int = 3) -> None:
+        self.server_url = server_url
+        self.failure_threshold = failure_threshold
+        self.failures = 0
+        self.open_since: float | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def healthy(self) -> bool:
+        return self.open_since is None
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold and self.open_since is None:
+                self.open_since = time.monotonic()
+                logging.warning(f"服务器 {self.server_url} 连续失败 {self.failures} 次，暂停派发任务")
+
+    def reset(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.open_since = None
+
+
+class WorkStealingScheduler:
+    """所有任务放入同一个队列，每个服务器拥有独立的工作线程。
+
+    服务器空闲时立即从队列中取出下一个任务，GPU 较快的服务器自然会处理更多图片，
+    总耗时接近 总工作量 / 服务器数，而不会被分到重任务的慢服务器拖住。
+
+    失败的任务按指数退避重新排队，优先交给其他服务器，最多重试 max_retries 次；
+    熔断的服务器由后台线程每 probe_interval 秒探测一次，全部服务器熔断超过
+    outage_timeout 秒后剩余任务直接记为失败。
+    """
+
+    def __init__(
+        self,
+        servers: list[str],
+        per_server_concurrency: int = 1,
+        max_in_flight: int | None = None,
+        max_retries: int = 2,
+        backoff_base: float = 2.0,
+        backoff_max: float = 30.0,
+        failure_threshold: int = 3,
+        probe_interval: float = 10.0,
+        outage_timeout: float = 60.0,
+    ) -> None:
+        self.servers = servers
+        self.per_server_concurrency = max(1, int(per_server_concurrency))
+        total = len(servers) * self.per_server_concurrency
+        self.max_in_flight = max(1, min(total, int(max_in_flight))) if max_in_flight else total
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.probe_interval = probe_interval
+        self.outage_timeout = outage_timeout
+        # 连接池需容纳全部并发请求，另留一个给状态探测与进度轮询
+        for server in servers:
+            get_session(server, self.per_server_concurrency + 1)
+        # 所有服务器合计的在途请求上限
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._lock = threading.Lock()
+        self.breakers = {server: CircuitBreaker(server, failure_threshold) for server in servers}
+        self.completed: dict[str, int] = {server: 0 for server in servers}
+        self.retries = 0
+        # 成功任务的 (服务器, 成本, 耗时)，用于更新 ServerTimings
+        self.timings: list[tuple[str, float, float]] = []
+
+    def _has_alternative(self, task: dict) -> bool:
+        """是否还有未让该任务失败过的健康服务器"""
+        return any(
+            breaker.healthy and server not in task["failed_servers"]
+            for server, breaker in self.breakers.items()
+        )
+
+    def _all_down_for(self) -> float:
+        """所有服务器都处于熔断状态的时长（秒），有健康服务器时为 0"""
+        if any(breaker.healthy for breaker in self.breakers.values()):
+            return 0.0
+        return time.monotonic() - max(breaker.open_since for breaker in self.breakers.values())
+
+    def _record_attempt(
+        self, task: dict, result: tuple[int, bool, str], server_url: str, elapsed: float
+    ) -> Optional[tuple[dict, float]]:
+        """记录一次请求的结果；需要重试时返回 (重新排队的任务, 退避秒数)，否则返回 None"""
+        breaker = self.breakers[server_url]
+        if result[1]:
+            breaker.record_success()
+            if "cost" in task:
+                with self._lock:
+                    self.timings.append((server_url, task["cost"], elapsed))
+            return None
+
+        breaker.record_failure()
+        if task["attempt"] >= self.max_retries:
+            return None
+        attempt = task["attempt"] + 1
+        delay = min(self.backoff_base * 2 ** (attempt - 1), self.backoff_max)
+        with self._lock:
+            self.retries += 1
+        logging.warning(f"图片 #{task['idx'] + 1} 第 {attempt} 次失败，{delay:.0f}s 后重新排队")
+        return {**task, "attempt": attempt, "failed_servers": (*task["failed_servers"], server_url)}, delay
+
+    def run(self, tasks: list[dict], worker=generate_single_image, on_result=None) -> list[tuple[int, bool, str]]:
+        """执行全部任务，返回每个任务最终的 (索引, 是否成功, 错误信息)
+
+        on_result(result, server_url) 在每个任务最终完成（成功或放弃重试）后于工作线程中调用。
+        """
+        if not tasks:
+            return []
+
+        queue: Queue = Queue()
+        for task in tasks:
+            queue.put({**task, "attempt": 0, "failed_servers": ()})
+        results: list[tuple[int, bool, str]] = []
+        pending = len(tasks)
+        done = threading.Event()
+        worker_count = len(self.servers) * self.per_server_concurrency
+
+        def finish(result: tuple[int, bool, str], server_url: str | None) -> None:
+            nonlocal pending
+            with self._lock:
+                results.append(result)
+                if server_url:
+                    self.completed[server_url] += 1
+                pending -= 1
+                if pending == 0:
+                    done.set()
+                    # 唤醒正在等待队列的工作线程
+                    for _ in range(worker_count):
+                        queue.put(None)
+            if on_result:
+                on_result(result, server_url)
+
+        def serve(server_url: str) -> None:
+            breaker = self.breakers[server_url]
+            while not done.is_set():
+                if not breaker.healthy:
+                    done.wait(0.5)
+                    continue
+                try:
+                    task = queue.get(timeout=0.2)
+                except Empty:
+                    continue
+                if task is None:
+                    return
+                # 在本服务器失败过的任务优先留给其他健康服务器
+                if server_url in task["failed_servers"] and self._has_alternative(task):
+                    queue.put(task)
+                    done.wait(0.1)
+                    continue
+                # 只在实际发送请求时占用全局并发名额
+                with self._slots:
+                    started = time.perf_counter()
+                    try:
+                        result = worker({**task, "server_url": server_url})
+                    except Exception as exc:
+                        logging.error(f"任务执行异常: {exc}")
+                        result = (task["idx"], False, str(exc))
+                    elapsed = time.perf_counter() - started
+
+                retry = self._record_attempt(task, result, server_url, elapsed)
+                if retry is None:
+                    finish(result, server_url)
+                else:
+                    timer = threading.Timer(retry[1], queue.put, args=(retry[0],))
+                    timer.daemon = True
+                    timer.start()
+
+        def probe() -> None:
+            while not done.wait(self.probe_interval):
+                for server, breaker in self.breakers.items():
+                    if not breaker.healthy and get_server_status(server):
+                        breaker.reset()
+                        logging.info(f"服务器已恢复: {server}")
+                if self._all_down_for() > self.outage_timeout:
+                    logging.error("所有服务器均不可用，放弃剩余任务")
+                    while True:
+                        try:
+                            task = queue.get_nowait()
+                        except Empty:
+                            break
+                        if task is None:
+                            break
+                        finish((task["idx"], False, "没有可用的WebUI服务器"), None)
+
+        threads = [
+            threading.Thread(target=serve, args=(server,), name=f"webui-{i}-{k}", daemon=True)
+            for i, server in enumerate(self.servers)
+            for k in range(self.per_server_concurrency)
+        ]
+        threads.append(threading.Thread(target=probe, name="webui-probe", daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+
+class AsyncWebUIScheduler(WorkStealingScheduler):
+    """基于 asyncio + httpx 的调度器，调度、重试与熔断规则与 WorkStealingScheduler 相同。
+
+    每个服务器保持 per_server_concurrency 个在途请求，上传、等待与下载互相重叠；
+    base64 解码与 PNG 写入在线程池中执行，不阻塞事件循环。
+    """
+
+    def run(self, tasks: list[dict], worker=None, on_result=None) -> list[tuple[int, bool, str]]:
+        """执行全部任务，返回每个任务最终的 (索引, 是否成功, 错误信息)
+
+        worker 为可选的协程函数 worker(task_info, client)，默认调用 txt2img 接口；
+        on_result(result, server_url) 在事件循环中调用。
+        """
+        if not tasks:
+            return []
+        if httpx is None:
+            raise RuntimeError("asyncio 引擎需要安装 httpx：pip install httpx")
+        return asyncio.run(self._run(tasks, worker or self._generate, on_result))
+
+    @staticmethod
+    async def _generate(task_info: dict, client) -> tuple[int, bool, str]:
+        """异步版 generate_single_image"""
+        idx = task_info["idx"]
+        server_url = task_info["server_url"]
+        try:
+            payload, body = prepare_request(task_info)
+            monitor = task_info.get("monitor")
+            trace = monitor.begin(server_url) if monitor else None
+            started = time.perf_counter()
+            try:
+                resp = await client.post(
+                    f"{server_url}/sdapi/v1/txt2img",
+                    content=body,
+                    headers={"Content-Type": "application/json"},
+                )
+            finally:
+                phases = monitor.end(server_url, trace) if monitor else None
+            resp.raise_for_status()
+            elapsed = time.perf_counter() - started
+            img_bytes = await asyncio.to_thread(decode_txt2img_response, resp.content, server_url)
+            await asyncio.to_thread(
+                save_generated_image, task_info, payload, img_bytes, server_url, elapsed, len(body), phases)
+            return idx, True, ""
+        except Exception as exc:
+            logging.error(f"生成失败（#{idx + 1}）：{exc} (服务器: {server_url})")
+            return idx, False, str(exc)
+
+    async def _run(self, tasks: list[dict], worker, on_result) -> list[tuple[int, bool, str]]:
+        queue: asyncio.Queue = asyncio.Queue()
+        for task in tasks:
+            queue.put_nowait({**task, "attempt": 0, "failed_servers": ()})
+        results: list[tuple[int, bool, str]] = []
+        pending = len(tasks)
+        done = asyncio.Event()
+        slots = asyncio.Semaphore(self.max_in_flight)
+        worker_count = len(self.servers) * self.per_server_concurrency
+        retries: set[asyncio.Task] = set()
+
+        timeout = httpx.Timeout(TXT2IMG_TIMEOUT[1], connect=TXT2IMG_TIMEOUT[0])
+        limits = httpx.Limits(
+            max_connections=self.per_server_concurrency,
+            max_keepalive_connections=self.per_server_concurrency,
+        )
+        # 所有客户端共用一个 SSL 上下文，避免每个客户端各自加载证书；纯 http 服务器无需加载
+        ssl_context = (
+            ssl.create_default_context()
+            if any(server.startswith("https://") for server in self.servers)
+            else False
+        )
+        clients = {
+            server: httpx.AsyncClient(timeout=timeout, limits=limits, verify=ssl_context)
+            for server in self.servers
+        }
+
+        async def wait_done(seconds: float) -> bool:
+            try:
+                await asyncio.wait_for(done.wait(), seconds)
+                return True
+            except asyncio.TimeoutError:
+                return False
+
+        def finish(result: tuple[int, bool, str], server_url: str | None) -> None:
+            nonlocal pending
+            results.append(result)
+            if server_url:
+                self.completed[server_url] += 1
+            pending -= 1
+            if pending == 0:
+                done.set()
+                # 唤醒正在等待队列的协程
+                for _ in range(worker_count):
+                    queue.put_nowait(None)
+            if on_result:
+                on_result(result, server_url)
+
+        async def requeue_later(task: dict, delay: float) -> None:
+            await asyncio.sleep(delay)
+            queue.put_nowait(task)
+
+        async def serve(server_url: str) -> None:
+            breaker = self.breakers[server_url]
+            while not done.is_set():
+                if not breaker.healthy:
+                    await wait_done(0.5)
+                    continue
+                try:
+                    task = await asyncio.wait_for(queue.get(), 0.2)
+                except asyncio.TimeoutError:
+                    continue
+                if task is None:
+                    return
+                # 在本服务器失败过的任务优先留给其他健康服务器
+                if server_url in task["failed_servers"] and self._has_alternative(task):
+                    queue.put_nowait(task)
+                    await wait_done(0.1)
+                    continue
+                # 只在实际发送请求时占用全局并发名额
+                async with slots:
+                    started = time.perf_counter()
+                    try:
+                        result = await worker({**task, "server_url": server_url}, clients[server_url])
+                    except Exception as exc:
+                        logging.error(f"任务执行异常: {exc}")
+                        result = (task["idx"], False, str(exc))
+                    elapsed = time.perf_counter() - started
+
+                retry = self._record_attempt(task, result, server_url, elapsed)
+                if retry is None:
+                    finish(result, server_url)
+                else:
+                    retry_task = asyncio.create_task(requeue_later(*retry))
+                    retries.add(retry_task)
+                    retry_task.add_done_callback(retries.discard)
+
+        async def probe() -> None:
+            while not await wait_done(self.probe_interval):
+                for server, breaker in self.breakers.items():
+                    if not breaker.healthy and await asyncio.to_thread(get_server_status, server):
+                        breaker.reset()
+                        logging.info(f"服务器已恢复: {server}")
+                if self._all_down_for() > self.outage_timeout:
+                    logging.error("所有服务器均不可用，放弃剩余任务")
+                    while not queue.empty():
+                        task = queue.get_nowait()
+                        if task is None:
+                            break
+                        finish((task["idx"], False, "没有可用的WebUI服务器"), None)
+
+        try:
+            await asyncio.gather(
+                *(serve(server) for server in self.servers for _ in range(self.per_server_concurrency)),
+                probe(),
+            )
+        finally:
+            for client in clients.values():
+                await client.aclose()
+        return results
+
+
+def make_scheduler(engine: str = "auto", *args, **kwargs) -> WorkStealingScheduler:
+    """按 engine 选择调度器：threads、async，或 auto（已安装 httpx 时使用 async）"""
+    if engine == "async" or (engine == "auto" and httpx is not None):
+        if httpx is None:
+            logging.warning("未安装 httpx，改用线程调度器")
+            return WorkStealingScheduler(*args, **kwargs)
+        return AsyncWebUIScheduler(*args, **kwargs)
+    return WorkStealingScheduler(*args, **kwargs)
+
 # ---------------------------------------------------------------------------
 # 核心生成流程（并行版本）
 # ---------------------------------------------------------------------------
@@ -256,8 +1171,20 @@ def run_webui_program(
     extra_params: dict[str, Any] | None = None,
     control_image: str | None = None,
     max_workers: int = None,
+    per_server_concurrency: int = 1,
+    engine: str = "auto",
+    on_image: Callable[[int, str], None] | None = None,
+    progress_interval: float = 1.0,
+    on_batch: Callable[[BatchProgress], None] | None = None,
 ) -> None:
-    """批量生成（或重绘）PNG 图片，支持多服务器并行。"""
+    """批量生成（或重绘）PNG 图片，支持多服务器并行。
+
+    每个服务器同时处理 per_server_concurrency 个请求，max_workers 限制所有服务器合计的并行数；
+    engine 可选 threads、async 或 auto（已安装 httpx 时使用 asyncio 引擎）。
+    每张图片保存（或从缓存复制）后调用 on_image(图片编号, 路径)，编号从 1 开始。
+    生成期间每 progress_interval 秒轮询各服务器进度；开始生成前调用 on_batch(BatchProgress)，
+    调用方可据此显示本批次的 ETA 与利用率。
+    """
 
     # 获取可用服务器
     available_servers = get_available_servers()
@@ -266,11 +1193,6 @@ def run_webui_program(
     
     logging.info(f"使用 {len(available_servers)} 个可用服务器: {available_servers}")
     
-    # 设置最大并行数
-    if max_workers is None:
-        max_workers = len(available_servers)
-    max_workers = min(max_workers, len(available_servers))
-    
     prompts = get_prompts(PROMPT_XLSX)
     break_counts = count_character(prompts)
 
@@ -314,56 +1236,158 @@ malformed limbs,extra limbs,ugly,poorly drawn hands,poorly drawn feet,poorly dra
 mutated hands,mutation,bad anatomy,cloned face,disfigured,fused fingers"""
 
     # 控制图（如果提供）
-    encoded_control_img = _encode_image_to_base64(control_image) if control_image else None
+    control = ControlImage(control_image) if control_image else None
+    if control:
+        logging.info(
+            f"控制图已缩放至 {control.size[0]}x{control.size[1]}："
+            f"{control.original_bytes / 1024:.0f} KiB → {len(control.base64) / 1024:.0f} KiB (base64)"
+        )
 
     # 准备任务列表
     tasks = []
-    for i, idx in enumerate(indices):
+    for idx in indices:
         prompt_core = prompts[idx]
         regional_counts = break_counts[idx]
         
-        # 轮询分配服务器
-        server_url = available_servers[i % len(available_servers)]
-        
+        # 服务器由调度器在任务出队时决定
         task_info = {
             "idx": idx,
             "prompt": prompt_core,
             "regional_counts": regional_counts,
             "params": params,
             "negative_prompt": negative_prompt,
-            "encoded_control_img": encoded_control_img,
-            "server_url": server_url
+            "control_image": control,
         }
+        task_info["cost"] = estimate_task_cost(task_info)
         tasks.append(task_info)
 
-    # 并行执行任务
-    success_count = 0
-    failed_indices = []
+    # 固定种子时结果可复现：请求内容与服务器模型都相同的图片直接从缓存复制
+    cached_indices = []
+    if params["seed"] != -1:
+        image_cache = ImageCache()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(available_servers)) as executor:
+            checkpoints = dict(zip(available_servers, executor.map(get_server_checkpoint, available_servers)))
+        models = sorted({checkpoint for checkpoint in checkpoints.values() if checkpoint})
+        remaining = []
+        for task in tasks:
+            task["image_cache"] = image_cache
+            task["checkpoints"] = checkpoints
+            payload = build_payload(task)
+            keys = [ImageCache.make_key(payload, control, checkpoint) for checkpoint in models]
+            out_path = os.path.join(IMAGE_DIR, f"output_{task['idx'] + 1}.png")
+            if keys and image_cache.restore(keys, out_path):
+                cached_indices.append(task["idx"])
+                if on_image:
+                    on_image(task["idx"] + 1, out_path)
+            else:
+                remaining.append(task)
+        tasks = remaining
+        logging.info(f"图片缓存：命中 {image_cache.hits}，未命中 {image_cache.misses}")
+
+    # 最长任务优先，减少批次末尾只剩少数服务器在处理大任务的情况
+    tasks.sort(key=lambda task: task["cost"], reverse=True)
+
+    # 并行执行任务：空闲的服务器从共享队列中领取下一个任务
+    scheduler = make_scheduler(engine, available_servers, per_server_concurrency, max_workers)
+    timings = ServerTimings()
+    predicted = timings.predict_makespan(
+        [task["cost"] for task in tasks], available_servers,
+        scheduler.per_server_concurrency, scheduler.max_in_flight)
+    logging.info(
+        f"{'asyncio' if isinstance(scheduler, AsyncWebUIScheduler) else '线程'}调度，"
+        f"每个服务器并发 {scheduler.per_server_concurrency} 个请求，"
+        f"合计最多 {scheduler.max_in_flight} 个"
+    )
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # 提交所有任务
-        future_to_task = {executor.submit(generate_single_image, task): task for task in tasks}
-        
-        # 使用 tqdm 显示进度
+    monitor = ProgressMonitor(available_servers, progress_interval).start()
+    for task in tasks:
+        task["monitor"] = monitor
+    batch = BatchProgress({task["idx"]: task["cost"] for task in tasks}, predicted, monitor, len(cached_indices))
+    if on_batch:
+        on_batch(batch)
+
+    # 使用 tqdm 显示进度
+    batch_start = time.perf_counter()
+    try:
         with tqdm(total=len(tasks), desc="并行生成中", unit="张") as pbar:
-            for future in concurrent.futures.as_completed(future_to_task):
-                task = future_to_task[future]
-                try:
-                    idx, success, error_msg = future.result()
-                    if success:
-                        success_count += 1
-                    else:
-                        failed_indices.append(idx + 1)
-                except Exception as exc:
-                    failed_indices.append(task["idx"] + 1)
-                    logging.error(f"任务执行异常: {exc}")
-                
+            def on_result(result: tuple[int, bool, str], server_url: str | None) -> None:
                 pbar.update(1)
+                idx, success, _ = result
+                batch.record(idx, success)
+                if success and on_image:
+                    on_image(idx + 1, os.path.join(IMAGE_DIR, f"output_{idx + 1}.png"))
+
+            results = scheduler.run(tasks, on_result=on_result)
+    finally:
+        monitor.stop()
+    actual = time.perf_counter() - batch_start
+    
+    for server_url, cost, elapsed in scheduler.timings:
+        timings.update(server_url, cost, elapsed)
+    timings.save()
+    
+    success_count = sum(1 for _, success, _ in results if success)
+    failed_indices = sorted(idx + 1 for idx, success, _ in results if not success)
     
     # 输出统计信息
-    logging.info(f"生成完成！成功: {success_count}/{len(tasks)}")
+    if cached_indices:
+        logging.info(f"{len(cached_indices)} 张图片来自缓存")
+    logging.info(f"生成完成！成功: {success_count + len(cached_indices)}/{len(tasks) + len(cached_indices)}")
     if failed_indices:
         logging.warning(f"失败的图片索引: {failed_indices}")
+    if scheduler.retries:
+        logging.info(f"共重试 {scheduler.retries} 次")
+    if predicted is not None:
+        logging.info(f"预计耗时 {predicted:.0f}s，实际耗时 {actual:.0f}s")
+    elif tasks:
+        logging.info(f"实际耗时 {actual:.0f}s（首次运行，已记录各服务器耗时用于下次预测）")
+    for server_url, count in scheduler.completed.items():
+        utilization = monitor.utilization(server_url)
+        logging.info(
+            f"服务器 {server_url} 处理了 {count} 张图片"
+            + (f"，利用率 {utilization:.0%}" if utilization is not None else "")
+        )
+    if tasks:
+        logging.info(f"各图片的排队、采样、高清修复与传输耗时已写入 {METRICS_LOG}")
+
+def iter_webui_program(
+    *args, heartbeat: float | None = None, **kwargs
+) -> Iterator[tuple[int, str] | BatchProgress | None]:
+    """参数与 run_webui_program 相同，在后台线程中生成图片，按完成顺序逐个产出 (图片编号, 路径)。
+
+    开始生成前产出本批次的 BatchProgress；指定 heartbeat 时，若 heartbeat 秒内没有新图片则产出 None，便于调用方刷新进度显示。
+    生成过程中的异常会在迭代结束时重新抛出。
+    """
+    events: Queue = Queue()
+    errors: list[BaseException] = []
+
+    def target() -> None:
+        try:
+            run_webui_program(
+                *args,
+                on_image=lambda number, path: events.put((number, path)),
+                on_batch=events.put,
+                **kwargs,
+            )
+        except BaseException as exc:
+            errors.append(exc)
+        finally:
+            events.put(None)
+
+    thread = threading.Thread(target=target, name="webui-batch", daemon=True)
+    thread.start()
+    while True:
+        try:
+            event = events.get(timeout=heartbeat)
+        except Empty:
+            yield None
+            continue
+        if event is None:
+            break
+        yield event
+    thread.join()
+    if errors:
+        raise errors[0]
 
 def get_generated_images():
     """获取已生成的图片信息，按场景分组"""
@@ -10,12 +10,112 @@ import asyncio
 import tqdm
 import argparse
 import json
-import re
+import hashlib
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from sentence_splitter import split_sentences
+
+def assemble_audio(chunks, leading_silence=0):
+    """把句子音频一次性写入预分配的 float32 缓冲区，开头可预留静音"""
+    total = leading_silence + sum(len(chunk) for chunk in chunks)
+    buffer = np.empty(total, dtype=np.float32)
+    buffer[:leading_silence] = 0
+    position = leading_silence
+    for chunk in chunks:
+        buffer[position:position + len(chunk)] = chunk
+        position += len(chunk)
+    return buffer
+
+class SentenceAudioCache:
+    """按句子内容寻址的音频缓存，保存在 voice/cache/<哈希>.npz
+
+    每个条目包含句子音频与句内短句的结束位置（采样点）。
+
+    命中时更新文件修改时间，总大小超过上限时按修改时间淘汰最久未使用的文件。
+    """
+
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        """返回 (修改时间, 大小, 路径) 列表；其他合成进程可能同时删除文件，已删除的跳过"""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(('.npy', '.npz')):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                wav = data['audio']
+                phrase_ends = data['phrase_ends'].tolist() if data['has_phrases'] else None
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return wav, phrase_ends
+
+    def put(self, key, wav, phrase_ends=None):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                audio=np.asarray(wav, dtype=np.float32),
+                phrase_ends=np.asarray(phrase_ends or [], dtype=np.int64),
+                has_phrases=phrase_ends is not None,
+            )
+        os.replace(tmp_path, path)
+        self.total_bytes += os.path.getsize(path)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """删除最久未使用的缓存，直到总大小降到上限的 90% 以下"""
+        entries = sorted(self._entries())
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
 
 class SpeechProvider:
-    def __init__(self, gender, language):
+    # KModel 的上下文长度为 512 个 token，去掉首尾填充后最多 510 个音素
+    MAX_PHONEMES = 510
+    # G2P 后句内停顿（，、；）对应的音素，用于切分短句时间戳
+    PHRASE_BREAKS = ',;'
+
+    def __init__(self, gender, language, batched=True, use_cache=True, device=None):
+        start = time.perf_counter()
         REPO_ID = 'hexgrad/Kokoro-82M-v1.1-zh'
-        kororo_path = os.path.join(os.path.dirname(__file__), '..', 'voice', 'Kokoro-82M-v1.1-zh')
+        voice_dir = os.path.join(os.path.dirname(__file__), '..', 'voice')
+        kororo_path = os.path.join(voice_dir, 'Kokoro-82M-v1.1-zh')
         config = kororo_path + '/config.json'
         model_pth = kororo_path + '/kokoro-v1_1-zh.pth'
 
@@ -24,11 +124,19 @@ class SpeechProvider:
         self.N_ZEROS = 10000
         # VOICES = glob.glob(f"./voice/Kokoro-82M-v1.1-zh/voices/{GENDER}*.pt")
         self.VOICE = kororo_path + '/voices/zf_003.pt' if gender == 'zf' else kororo_path + '/voices/zm_031.pt'
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
         self.model = KModel(repo_id=REPO_ID, config=config, model=model_pth).to(self.device).eval()
         self.en_pipeline = KPipeline(lang_code='a', repo_id=REPO_ID, model=False)
         self.zh_pipeline = KPipeline(lang_code='z', repo_id=REPO_ID, model=self.model, en_callable=self.en_callable)
-        self.zh_pipeline.load_voice
+        self.voice_pack = self.zh_pipeline.load_voice(self.VOICE).to(self.device)
+        # 批量模式：先对整段文本做 G2P，再把多个句子拼成一次推理
+        self.batched = batched
+        self.model_id = f"{REPO_ID}/{os.path.basename(model_pth)}"
+        self.cache = SentenceAudioCache(os.path.join(voice_dir, 'cache')) if use_cache else None
+        # 同一个模型实例不在多个线程中同时推理
+        self.lock = threading.Lock()
+        self.load_time = time.perf_counter() - start
+        print(f"Kokoro 模型加载完成（{self.device}），用时 {self.load_time:.1f}s")
 
 
     def en_callable(self,text):
@@ -42,75 +150,318 @@ class SpeechProvider:
         speed = 1
         return speed 
 
+    def phonemize(self, sentence):
+        """将句子转换为音素，超长部分按 KPipeline 的规则截断"""
+        ps, _ = self.zh_pipeline.g2p(sentence)
+        return (ps or '')[:self.MAX_PHONEMES]
+
+    def count_tokens(self, phonemes):
+        """音素串中能被模型识别的 token 数"""
+        return sum(1 for p in phonemes if p in self.model.vocab)
+
+    def make_batches(self, phoneme_list):
+        """按顺序把句子装入批次，每批拼接后的音素数不超过上下文长度"""
+        batches = []
+        current = []
+        current_len = 0
+        for index, ps in enumerate(phoneme_list):
+            if not ps:
+                continue
+            added_len = len(ps) + (1 if current else 0)
+            if current and current_len + added_len > self.MAX_PHONEMES:
+                batches.append(current)
+                current, current_len, added_len = [], 0, len(ps)
+            current.append(index)
+            current_len += added_len
+        if current:
+            batches.append(current)
+        return batches
+
+    def synthesize_batch(self, phoneme_list):
+        """一次前向推理合成多个句子，并按预测的音素时长切分回每个句子
+
+        返回每个句子的 (音频, 句内短句结束位置)，位置为相对句首的采样点。
+        """
+        joined = ' '.join(phoneme_list)
+        output = self.model(joined, self.voice_pack[len(joined) - 1], self.speed_callable(len(joined)), return_output=True)
+        audio = output.audio.numpy()
+        pred_dur = output.pred_dur.numpy()
+
+        frame_ends = np.cumsum(pred_dur)
+        samples_per_frame = len(audio) / max(frame_ends[-1], 1)
+
+        def sample_at(token):
+            # 第 token 个 token（含）结束时的采样点
+            return int(round(frame_ends[token] * samples_per_frame))
+
+        # token 序列为 [BOS, 句子1, 空格, 句子2, ..., EOS]，分隔空格归入前一句
+        separator_tokens = self.count_tokens(' ')
+        results = []
+        token = 0
+        start = 0
+        for k, ps in enumerate(phoneme_list):
+            phrase_tokens = []
+            for p in ps:
+                if p in self.model.vocab:
+                    token += 1
+                    if p in self.PHRASE_BREAKS:
+                        phrase_tokens.append(token)
+            if k < len(phoneme_list) - 1:
+                token += separator_tokens
+                end = sample_at(token)
+            else:
+                end = len(audio)
+            results.append((audio[start:end], [sample_at(t) - start for t in phrase_tokens]))
+            start = end
+        return results
+
+    def cache_key(self, sentence):
+        """句子文本、音色、语速与模型共同决定缓存键"""
+        key = json.dumps([
+            sentence,
+            os.path.basename(self.VOICE),
+            self.speed_callable(len(sentence)),
+            self.model_id,
+            self.batched,
+        ], ensure_ascii=False)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def synthesize_sentences(self, sentences):
+        """合成一个段落的所有句子，返回每个句子的 (音频, 短句结束位置)；已缓存的句子不再合成"""
+        if self.cache is None:
+            return self.synthesize_uncached(sentences)
+
+        keys = [self.cache_key(sentence) for sentence in sentences]
+        results = [self.cache.get(key) for key in keys]
+        missing = [index for index, result in enumerate(results) if result is None]
+        if missing:
+            for index, result in zip(missing, self.synthesize_uncached([sentences[i] for i in missing])):
+                self.cache.put(keys[index], *result)
+                results[index] = result
+        return results
+
+    def synthesize_uncached(self, sentences):
+        """直接调用模型合成句子，逐句模式下没有短句时间戳"""
+        if not self.batched:
+            results = []
+            for sentence in sentences:
+                generator = self.zh_pipeline(sentence, voice=self.VOICE, speed=self.speed_callable)
+                result = next(generator)
+                results.append((np.asarray(result.audio), None))
+            return results
+
+        phoneme_list = [self.phonemize(sentence) for sentence in sentences]
+        results = [(np.zeros(0, dtype=np.float32), []) for _ in sentences]
+        for batch in self.make_batches(phoneme_list):
+            for index, result in zip(batch, self.synthesize_batch([phoneme_list[i] for i in batch])):
+                results[index] = result
+        return results
+
+    def synthesize_paragraph(self, paragraph, leading_silence=False):
+        """合成一个段落
+
+        返回 (段落音频, 每个句子的时长, 每个句子的 [开始, 结束], 每个句子的短句 [[开始, 结束], ...])，
+        时间单位为秒；开始、结束为相对段落音频起点的偏移，不含开头的静音。
+        """
+        results = self.synthesize_sentences(paragraph)
+        wavs = [wav for wav, _ in results]
+        # 计算每个句子的时长（秒）
+        sentence_durations = [len(wav) / self.SAMPLE_RATE for wav in wavs]
+
+        silence = self.N_ZEROS if leading_silence else 0
+        if sentence_durations and silence > 0:
+            # 添加静音时长
+            sentence_durations[0] += silence / self.SAMPLE_RATE
+
+        sentence_offsets = []
+        phrase_offsets = []
+        position = silence
+        for wav, phrase_ends in results:
+            start = position / self.SAMPLE_RATE
+            end = (position + len(wav)) / self.SAMPLE_RATE
+            sentence_offsets.append([start, end])
+            if phrase_ends is None:
+                phrase_offsets.append(None)
+            else:
+                bounds = [start] + [(position + e) / self.SAMPLE_RATE for e in phrase_ends] + [end]
+                phrase_offsets.append([[bounds[j], bounds[j + 1]] for j in range(len(bounds) - 1)])
+            position += len(wav)
+
+        return assemble_audio(wavs, silence), sentence_durations, sentence_offsets, phrase_offsets
+
     def get_tts_audio(self, message):
         wavs_tot = []
         durations = []  # 添加时长记录
         
-        for paragraph in tqdm.tqdm(message, desc="正在生成配音音频", unit="paragraphs"):
-            wavs_para = []
-            sentence_durations = []  # 记录每个句子的时长
-            
-            for i, sentence in enumerate(paragraph):
-                # print(f"正在处理句子: {sentence}")
-                generator = self.zh_pipeline(sentence, voice=self.VOICE, speed=self.speed_callable)
-                result = next(generator)
-                wav = result.audio
-                
-                # 计算当前句子的时长（秒）
-                sentence_duration = len(wav) / self.SAMPLE_RATE
-                sentence_durations.append(sentence_duration)
-                
-                if i == 0 and wavs_tot and self.N_ZEROS > 0:
-                    wav = np.concatenate([np.zeros(self.N_ZEROS), wav])
-                    # 添加静音时长
-                    sentence_durations[-1] += self.N_ZEROS / self.SAMPLE_RATE
-                    
-                if i == 0:
-                    wavs_para = wav
-                else:
-                    wavs_para = np.concatenate([wavs_para, wav])
-                    
+        for index, paragraph in enumerate(tqdm.tqdm(message, desc="正在生成配音音频", unit="paragraphs")):
+            # 除第一段外，段落之间插入静音
+            wavs_para, sentence_durations, _, _ = self.synthesize_paragraph(paragraph, leading_silence=index > 0)
             wavs_tot.append(wavs_para)
             durations.append(sentence_durations)
 
         return 'wav', wavs_tot, durations
 
-def convert_text_to_audio(tasks, language, output_path, gender):
+# 进程内共享的 SpeechProvider，按 (性别, 语言, 设备, 批量模式) 区分
+_provider_pool = {}
+_provider_pool_lock = threading.Lock()
+
+def get_speech_provider(gender, language, batched=True, device=None):
+    """获取进程内共享的 SpeechProvider，首次调用时加载模型，之后直接复用"""
+    device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    key = (gender, language, device, batched)
+    with _provider_pool_lock:
+        if key not in _provider_pool:
+            _provider_pool[key] = SpeechProvider(gender, language, batched=batched, device=device)
+        return _provider_pool[key]
+
+def prewarm_speech_provider(gender='zf', language='zh', batched=True):
+    """在后台线程中预先加载模型并合成一句短句，返回该线程"""
+    def warm_up():
+        start = time.perf_counter()
+        provider = get_speech_provider(gender, language, batched)
+        with provider.lock:
+            first_start = time.perf_counter()
+            provider.synthesize_uncached(["你好。"])
+        print(f"语音模型预热完成：加载 {first_start - start:.1f}s，首句合成 {time.perf_counter() - first_start:.2f}s")
+
+    thread = threading.Thread(target=warm_up, name="tts-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+def make_timing_entry(wav_para, duration_list, sample_rate, text_hash=None, sentence_offsets=None, phrase_offsets=None):
+    """生成 audio_timing.json 中单个场景的时长信息
+
+    sentence_offsets 为每个句子在场景音频中的 [开始, 结束]（秒），
+    phrase_offsets 为每个句子内按逗号、分号切分的短句时间，无法获得时为 null。
+    """
+    return {
+        "total_duration": len(wav_para) / sample_rate,
+        "sentence_durations": duration_list,
+        "sentence_offsets": sentence_offsets,
+        "phrase_offsets": phrase_offsets,
+        "sample_rate": sample_rate,
+        "text_hash": text_hash
+    }
+
+def scene_text_hash(paragraph, gender, language, batched, leading_silence):
+    """场景文本与合成参数的哈希，用于判断已有音频能否复用"""
+    key = json.dumps([list(paragraph), gender, language, batched, leading_silence], ensure_ascii=False)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def write_wav_atomic(wav_file_path, wav_para, sample_rate):
+    """先写临时文件再重命名，避免中断时留下不完整的 wav"""
+    tmp_path = f"{wav_file_path}.{os.getpid()}.tmp"
+    sf.write(tmp_path, wav_para, sample_rate, format='WAV')
+    os.replace(tmp_path, wav_file_path)
+
+def save_timing_info(timing_file, timing_info):
+    """原子地写入 audio_timing.json"""
+    tmp_file = f"{timing_file}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(timing_info, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_file, timing_file)
+
+def load_timing_info(timing_file):
+    if os.path.exists(timing_file):
+        try:
+            with open(timing_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            pass
+    return {}
+
+def synthesize_scene(provider, index, paragraph, output_path, text_hash):
+    """合成单个场景并立即写出 output_{index}.wav
+
+    返回 (索引, 文件路径, 时长信息, (缓存命中数, 未命中数))
+    """
+    with provider.lock:
+        hits, misses = (provider.cache.hits, provider.cache.misses) if provider.cache else (0, 0)
+        wav_para, duration_list, sentence_offsets, phrase_offsets = provider.synthesize_paragraph(
+            paragraph, leading_silence=index > 0)
+        if provider.cache:
+            hits, misses = provider.cache.hits - hits, provider.cache.misses - misses
+    wav_file_path = os.path.join(output_path, f"output_{index}.wav")
+    write_wav_atomic(wav_file_path, wav_para, provider.SAMPLE_RATE)
+    entry = make_timing_entry(wav_para, duration_list, provider.SAMPLE_RATE, text_hash, sentence_offsets, phrase_offsets)
+    return index, wav_file_path, entry, (hits, misses)
+
+# 子进程中的 SpeechProvider，每个进程只加载一次模型
+_worker_provider = None
+
+def _init_tts_worker(gender, language, batched, num_threads):
+    global _worker_provider
+    torch.set_num_threads(num_threads)
+    # 直接创建，不经过进程内共享的 _provider_pool
+    _worker_provider = SpeechProvider(gender, language, batched=batched)
+
+def _synthesize_scene(index, paragraph, output_path, text_hash):
+    return synthesize_scene(_worker_provider, index, paragraph, output_path, text_hash)
+
+def iter_synthesized_scenes(pending, language, output_path, gender, batched, workers):
+    """逐个产出合成完成的场景；workers > 1 时按场景分发到进程池，每个进程独立加载 KModel"""
+    if workers == 1:
+        provider = get_speech_provider(gender, language, batched)
+        for index, paragraph, text_hash in pending:
+            yield synthesize_scene(provider, index, paragraph, output_path, text_hash)
+        return
+
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f"使用 {workers} 个进程合成配音，每个进程 {num_threads} 个线程")
+    # 使用 spawn：fork 会继承主进程已加载的模型与 CUDA 上下文，以及预热线程可能持有的锁
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_tts_worker,
+        initargs=(gender, language, batched, num_threads),
+    ) as executor:
+        futures = [
+            executor.submit(_synthesize_scene, index, paragraph, output_path, text_hash)
+            for index, paragraph, text_hash in pending
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+def convert_text_to_audio(tasks, language, output_path, gender, batched=True, workers=1):
     if not tasks:
         return False
 
-    provider = SpeechProvider(gender, language)
-    wav_format, wavs, durations = provider.get_tts_audio(tasks)
-    
-    if wav_format != 'wav':
-        raise ValueError("Unsupported audio format")
-        
-    # 保存音频文件和时长信息
-    timing_info = {}
-    audio_files = []
-    if wavs is not None:
-        for index, (wav_para, duration_list) in enumerate(zip(wavs, durations)):
-            wav_file_path = os.path.join(output_path, f"output_{index}.wav")
-            sf.write(wav_file_path, wav_para, provider.SAMPLE_RATE)
-            audio_files.append(wav_file_path)
-            
-            # 记录时长信息
-            total_duration = len(wav_para) / provider.SAMPLE_RATE
-            timing_info[f"output_{index}"] = {
-                "total_duration": total_duration,
-                "sentence_durations": duration_list,
-                "sample_rate": provider.SAMPLE_RATE
-            }
-    
-    # 保存时长信息到JSON文件
     timing_file = os.path.join(output_path, "audio_timing.json")
-    with open(timing_file, 'w', encoding='utf-8') as f:
-        json.dump(timing_info, f, indent=2, ensure_ascii=False)
-    
+    previous = load_timing_info(timing_file)
+    audio_files = [os.path.join(output_path, f"output_{index}.wav") for index in range(len(tasks))]
+
+    # 文本与参数未变且音频已存在的场景直接复用
+    timing_info = {}
+    pending = []
+    for index, paragraph in enumerate(tasks):
+        key = f"output_{index}"
+        text_hash = scene_text_hash(paragraph, gender, language, batched, index > 0)
+        if previous.get(key, {}).get("text_hash") == text_hash and os.path.exists(audio_files[index]):
+            timing_info[key] = previous[key]
+        else:
+            pending.append((index, paragraph, text_hash))
+    if len(pending) < len(tasks):
+        print(f"{len(tasks) - len(pending)} 个场景的音频未发生变化，跳过合成")
+
+    if pending:
+        workers = max(1, min(int(workers), len(pending)))
+        scenes = iter_synthesized_scenes(pending, language, output_path, gender, batched, workers)
+        cache_hits = cache_misses = 0
+        for index, wav_file_path, entry, (hits, misses) in tqdm.tqdm(scenes, total=len(pending), desc="正在生成配音音频", unit="paragraphs"):
+            # 每完成一个场景就更新时长信息，中断后可从此处继续
+            timing_info[f"output_{index}"] = entry
+            save_timing_info(timing_file, {**previous, **timing_info})
+            cache_hits += hits
+            cache_misses += misses
+        print(f"句子音频缓存：命中 {cache_hits} 句，未命中 {cache_misses} 句")
+
+    # 按场景顺序保存时长信息到JSON文件
+    save_timing_info(timing_file, {f"output_{index}": timing_info[f"output_{index}"] for index in range(len(tasks))})
+
     print(f"✅ 音频时长信息已保存到: {timing_file}")
     return True, audio_files
 
-def process_text_files(input_file, output_dir, language, gender):
+def process_text_files(input_file, output_dir, language, gender, batched=True, workers=1):
     print("BADAPPLE")
     with open(input_file, 'r', encoding='utf-8') as f:
         data = json.load(f)
@@ -120,31 +471,8 @@ def process_text_files(input_file, output_dir, language, gender):
     
     for scenario_idx, scenario in enumerate(scenarios):
         print("="*50)
-        # 先处理双引号包裹的句子
-        quote_pattern = r'“([^”]*[。！？])”'
-        quotes = re.findall(quote_pattern, scenario)
-        
-        # 将双引号内容替换为占位符
-        temp_scenario = scenario
-        placeholders = {}
-        for i, quote in enumerate(quotes):
-            placeholder = f"__QUOTE_{i}__"
-            placeholders[placeholder] = quote
-            temp_scenario = temp_scenario.replace(f'“{quote}”', placeholder)
-
-        sentences = re.split(r'([。！？.!?])', temp_scenario)
-        processed_sentences = []
-        
-        for i in range(0, len(sentences), 2):
-            if i < len(sentences):
-                s = sentences[i].strip()
-                if s:
-                    # 添加标点符号（如果存在）
-                    if i + 1 < len(sentences) and sentences[i + 1]:
-                        s += sentences[i + 1]
-                    for placeholder, quote in placeholders.items():
-                        s = s.replace(placeholder, f'“{quote}”')
-                    processed_sentences.append(s)
+        # 以句末标点结尾的引语整体保留
+        processed_sentences = split_sentences(scenario)
 
         if processed_sentences:
             tasks.append(tuple(processed_sentences))
@@ -161,13 +489,13 @@ def process_text_files(input_file, output_dir, language, gender):
     
     print(f"✅ 句子映射信息已保存到: {mapping_file}")
     
-    return convert_text_to_audio(tasks, language, output_dir, gender)
+    return convert_text_to_audio(tasks, language, output_dir, gender, batched, workers)
 
 
-def main(input_file, output_dir, language, gender):
+def main(input_file, output_dir, language, gender, batched=True, workers=1):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    return process_text_files(input_file, output_dir, language, gender)
+    return process_text_files(input_file, output_dir, language, gender, batched, workers)
 
 
 if __name__ == "__main__":
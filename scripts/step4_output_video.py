@@ -1,10 +1,18 @@
 import os
 import gc
 import random
-from concurrent.futures import ThreadPoolExecutor
+import time
+import argparse
+import subprocess
+import hashlib
+import bisect
+import itertools
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image, ImageFilter, ImageDraw, ImageFont
 from moviepy.editor import (
-    ImageSequenceClip,
+    VideoClip,
     AudioFileClip,
     CompositeVideoClip,
     concatenate_videoclips,
@@ -12,14 +20,38 @@ from moviepy.editor import (
     vfx,
     TextClip  # 添加 TextClip 导入
 )
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
 import json
 from datetime import datetime
 import chardet
 import concurrent.futures
 from tqdm import tqdm
 import numpy as np
-import textwrap
-import re
+
+from sentence_splitter import split_clauses
+
+# 导出配置：intermediate 用于 temp 下的场景视频，delivery 用于最终视频
+DEFAULT_EXPORT_PROFILES = {
+    "intermediate": {
+        "codec": "libx264",
+        "preset": "ultrafast",
+        "crf": 0,
+        "threads": 0,
+        "pixel_format": "yuv420p",
+        "audio_codec": "aac",
+        "audio_bitrate": "192k",
+    },
+    "delivery": {
+        "codec": "libx264",
+        "preset": "medium",
+        "crf": 20,
+        "threads": 0,
+        "pixel_format": "yuv420p",
+        "audio_codec": "aac",
+        "audio_bitrate": "128k",
+    },
+}
 
 def get_config():
     config_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.json')
@@ -30,6 +62,42 @@ def get_config():
 
     return json.loads(raw_data.decode(encoding))
 
+def get_export_profile(config, name):
+    """按名称读取导出配置，config.json 中的 export_profiles 覆盖默认值"""
+    profiles = {**DEFAULT_EXPORT_PROFILES, **config.get('export_profiles', {})}
+    if name not in profiles:
+        raise ValueError(f"未知的导出配置: {name}")
+    return {**DEFAULT_EXPORT_PROFILES['delivery'], **profiles[name]}
+
+def write_videofile_args(profile, size=None):
+    """将导出配置转换为 moviepy write_videofile 的参数"""
+    ffmpeg_params = ['-crf', str(profile['crf'])]
+    # 奇数尺寸无法使用 yuv420p，交给编码器自行选择
+    if profile.get('pixel_format') and (size is None or (size[0] % 2 == 0 and size[1] % 2 == 0)):
+        ffmpeg_params += ['-pix_fmt', profile['pixel_format']]
+    return {
+        'codec': profile['codec'],
+        'preset': profile['preset'],
+        'threads': profile.get('threads'),
+        'audio_codec': profile['audio_codec'],
+        'audio_bitrate': profile['audio_bitrate'],
+        'ffmpeg_params': ffmpeg_params,
+    }
+
+def ffmpeg_encode_args(profile):
+    """将导出配置转换为 ffmpeg 命令行的编码参数"""
+    args = [
+        '-c:v', profile['codec'],
+        '-preset', profile['preset'],
+        '-crf', str(profile['crf']),
+    ]
+    if profile.get('pixel_format'):
+        args += ['-pix_fmt', profile['pixel_format']]
+    if profile.get('threads') is not None:
+        args += ['-threads', str(profile['threads'])]
+    args += ['-c:a', profile['audio_codec'], '-b:a', profile['audio_bitrate']]
+    return args
+
 def transform_image(img, t, x_speed, y_speed, move_on_x, move_positive):
     original_size = img.size
 
@@ -50,67 +118,289 @@ def transform_image(img, t, x_speed, y_speed, move_on_x, move_positive):
     return cropped_img.resize(original_size)
 
 
-def create_subtitle_image(text, width, height, fontsize=36):
-    """创建简洁的字幕图像"""
-    img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(img)
-    
-    try:
-        # 尝试使用支持中文的字体
-        font = ImageFont.truetype("C:/Windows/Fonts/simhei.ttf", fontsize)
-    except:
+class KenBurnsRenderer:
+    """平移特效渲染器：图像只解码并放大一次，逐帧通过整数偏移切片取出画面
+
+    与 transform_image 等价：裁剪 crop_ratio 大小的窗口再放大回原尺寸，
+    相当于在放大 1/crop_ratio 倍的缓冲区上截取原尺寸的窗口。
+    """
+
+    def __init__(self, img, crop_ratio=0.8):
+        self.width, self.height = img.size
+        self.crop_ratio = crop_ratio
+        scale = 1 / crop_ratio
+        upscaled = img.convert('RGB').resize(
+            (round(self.width * scale), round(self.height * scale)), Image.Resampling.BICUBIC)
+        self.buffer = np.asarray(upscaled)
+
+    def crop_windows(self, segment_frames, fps, x_speed, y_speed, move_on_x, move_positive):
+        """预先计算整个片段每一帧的裁剪窗口左上角（放大缓冲区坐标，整数）"""
+        t = np.arange(segment_frames) / fps
+        crop_width = self.width * self.crop_ratio
+        crop_height = self.height * self.crop_ratio
+        if move_on_x:
+            max_offset = self.width - crop_width
+            left = np.minimum(x_speed * t, max_offset) if move_positive else np.maximum(max_offset - x_speed * t, 0)
+            upper = np.full(segment_frames, (self.height - crop_height) / 2)
+        else:
+            max_offset = self.height - crop_height
+            upper = np.minimum(y_speed * t, max_offset) if move_positive else np.maximum(max_offset - y_speed * t, 0)
+            left = np.full(segment_frames, (self.width - crop_width) / 2)
+
+        scale = 1 / self.crop_ratio
+        max_left = self.buffer.shape[1] - self.width
+        max_upper = self.buffer.shape[0] - self.height
+        left = np.clip(np.rint(left * scale), 0, max_left).astype(np.intp)
+        upper = np.clip(np.rint(upper * scale), 0, max_upper).astype(np.intp)
+        return np.stack([left, upper], axis=1)
+
+    def frame(self, left, upper):
+        """返回单帧画面（放大缓冲区上的视图，不复制数据）"""
+        return self.buffer[upper:upper + self.height, left:left + self.width]
+
+    def frames(self, windows):
+        for left, upper in windows:
+            yield self.frame(left, upper)
+
+
+class SegmentFrameSource:
+    """按需合成片段画面：模糊背景 + 平移前景 + 字幕，任意时刻只保留一帧"""
+
+    def __init__(self, renderer, windows, background, subtitles, fps):
+        self.renderer = renderer
+        self.windows = windows
+        self.background = background
+        # subtitles: [(RGBA 字幕贴片, (x, y), 开始时间, 结束时间)]，预先拆分颜色与透明度
+        self.subtitles = []
+        for tile, (x, y), start_time, end_time in subtitles:
+            if tile.size:
+                alpha = tile[..., 3:4].astype(np.float32) / 255
+                color = tile[..., :3].astype(np.float32) * alpha
+                self.subtitles.append((color, 1 - alpha, x, y, start_time, end_time))
+        self.fps = fps
+        bg_height, bg_width = background.shape[:2]
+        self.offset_x = (bg_width - renderer.width) // 2
+        self.offset_y = (bg_height - renderer.height) // 2
+
+    @property
+    def duration(self):
+        return len(self.windows) / self.fps
+
+    def make_frame(self, t):
+        index = min(int(t * self.fps + 1e-6), len(self.windows) - 1)
+        frame = self.background.copy()
+        foreground = self.renderer.frame(*self.windows[index])
+        fg_height, fg_width = foreground.shape[:2]
+        # 前景大于背景时按居中位置裁掉超出部分
+        src_x, src_y = max(0, -self.offset_x), max(0, -self.offset_y)
+        dst_x, dst_y = max(0, self.offset_x), max(0, self.offset_y)
+        w = min(fg_width - src_x, frame.shape[1] - dst_x)
+        h = min(fg_height - src_y, frame.shape[0] - dst_y)
+        frame[dst_y:dst_y + h, dst_x:dst_x + w] = foreground[src_y:src_y + h, src_x:src_x + w]
+
+        # 只在字幕贴片所在区域做透明度混合
+        for color, inv_alpha, x, y, start_time, end_time in self.subtitles:
+            if start_time <= t < end_time:
+                region = frame[y:y + color.shape[0], x:x + color.shape[1]]
+                region[:] = color + region * inv_alpha
+        return frame
+
+    def to_clip(self):
+        return VideoClip(self.make_frame, duration=self.duration)
+
+
+SUBTITLE_FONT_CANDIDATES = ("C:/Windows/Fonts/simhei.ttf", "arial.ttf")
+
+@lru_cache(maxsize=32)
+def load_font(path, size):
+    """加载 TrueType 字体，按 (路径, 字号) 缓存"""
+    return ImageFont.truetype(path, size)
+
+@lru_cache(maxsize=32)
+def load_subtitle_font(fontsize):
+    """加载支持中文的字幕字体，找不到时依次回退"""
+    for path in SUBTITLE_FONT_CANDIDATES:
         try:
-            font = ImageFont.truetype("arial.ttf", fontsize)
-        except:
-            font = ImageFont.load_default()
-    
+            return load_font(path, fontsize)
+        except (OSError, ValueError):
+            continue
+    return ImageFont.load_default()
+
+@lru_cache(maxsize=256)
+def render_subtitle_tile(text, width, height, fontsize=36):
+    """渲染字幕贴片，只包含文本框区域
+
+    返回 (RGBA 贴片, (x, y))，(x, y) 为贴片在 width x height 画面中的左上角位置。
+    """
+    empty = np.zeros((0, 0, 4), dtype=np.uint8)
     if not text.strip():
-        return np.array(img)
-    
+        return empty, (0, 0)
+
+    font = load_subtitle_font(fontsize)
+    measure = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+
     # 获取文本尺寸
-    bbox = draw.textbbox((0, 0), text, font=font)
+    bbox = measure.textbbox((0, 0), text, font=font)
     text_width = bbox[2] - bbox[0]
     text_height = bbox[3] - bbox[1]
-    
+
     # 确保字幕在屏幕范围内
     margin = 20
     if text_width > width - 2 * margin:
         # 如果文本太宽，缩小字体
-        fontsize = int(fontsize * (width - 2 * margin) / text_width)
-        try:
-            font = ImageFont.truetype("C:/Windows/Fonts/simhei.ttf", fontsize)
-        except:
-            font = ImageFont.load_default()
-        bbox = draw.textbbox((0, 0), text, font=font)
+        fontsize = max(1, int(fontsize * (width - 2 * margin) / text_width))
+        font = load_subtitle_font(fontsize)
+        bbox = measure.textbbox((0, 0), text, font=font)
         text_width = bbox[2] - bbox[0]
         text_height = bbox[3] - bbox[1]
-    
+
     # 计算居中位置（靠近底部）
     x = (width - text_width) // 2
     y = height - text_height - 80  # 距离底部80像素
-    
+
     # 确保不会超出边界
     x = max(margin, min(x, width - text_width - margin))
     y = max(margin, min(y, height - text_height - margin))
-    
-    # 绘制半透明背景
+
+    # 半透明背景
     bg_padding = 10
-    bg_left = x - bg_padding
-    bg_top = y - bg_padding
-    bg_right = x + text_width + bg_padding
-    bg_bottom = y + text_height + bg_padding
-    draw.rectangle([bg_left, bg_top, bg_right, bg_bottom], fill=(0, 0, 0, 128))
-    
+    bg_box = (x - bg_padding, y - bg_padding, x + text_width + bg_padding, y + text_height + bg_padding)
+
+    # 贴片区域：背景框与带描边的文本范围的并集，并限制在画面内
+    text_box = measure.textbbox((x, y), text, font=font)
+    left = max(0, min(bg_box[0], text_box[0] - 1))
+    top = max(0, min(bg_box[1], text_box[1] - 1))
+    right = min(width, max(bg_box[2] + 1, text_box[2] + 1))
+    bottom = min(height, max(bg_box[3] + 1, text_box[3] + 1))
+    if right <= left or bottom <= top:
+        return empty, (0, 0)
+
+    img = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    x, y = x - left, y - top
+
+    # 绘制半透明背景
+    draw.rectangle([bg_box[0] - left, bg_box[1] - top, bg_box[2] - left, bg_box[3] - top], fill=(0, 0, 0, 128))
+
     # 绘制文本描边
     for dx in [-1, 0, 1]:
         for dy in [-1, 0, 1]:
             if dx != 0 or dy != 0:
                 draw.text((x + dx, y + dy), text, font=font, fill=(0, 0, 0, 255))
-    
+
     # 绘制主文本
     draw.text((x, y), text, font=font, fill=(255, 255, 255, 255))
-    
-    return np.array(img)
+
+    tile = np.array(img)
+    tile.setflags(write=False)
+    return tile, (left, top)
+
+def create_subtitle_image(text, width, height, fontsize=36):
+    """创建简洁的字幕图像"""
+    img = np.zeros((height, width, 4), dtype=np.uint8)
+    tile, (x, y) = render_subtitle_tile(text, width, height, fontsize)
+    img[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+    return img
+
+class BackgroundCache:
+    """模糊背景缓存：内存 LRU + 可选的磁盘缓存
+
+    以图片内容哈希、尺寸与是否放大作为键，同一张图片在多次渲染间只模糊一次。
+    磁盘缓存命中时更新文件修改时间，总大小超过上限时按修改时间淘汰最久未使用的文件。
+    """
+
+    def __init__(self, max_items=16, cache_dir=None, max_bytes=1 << 30):
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        # (路径, 修改时间, 大小) -> 内容哈希，避免每次命中都重新读取整张图片
+        self._hashes = {}
+        self.total_bytes = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.total_bytes = sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        """返回 (修改时间, 大小, 路径) 列表；其他渲染进程可能同时删除文件，已删除的跳过"""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not (entry.name.startswith('blur_') and entry.name.endswith('.png')):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _hash(self, img_path):
+        stat = os.stat(img_path)
+        stamp = (img_path, stat.st_mtime_ns, stat.st_size)
+        if stamp not in self._hashes:
+            self._hashes[stamp] = hash_file(img_path)
+        return self._hashes[stamp]
+
+    def get(self, img_path, im, enlarge_background):
+        size = im.size
+        if enlarge_background:
+            # 保持偶数尺寸，yuv420p 编码要求宽高为偶数
+            size = (int(im.width * 1.1) // 2 * 2, int(im.height * 1.1) // 2 * 2)
+        key = f"{self._hash(img_path)[:32]}_{size[0]}x{size[1]}"
+        if key in self._items:
+            self._items.move_to_end(key)
+            return self._items[key]
+
+        cache_file = os.path.join(self.cache_dir, f'blur_{key}.png') if self.cache_dir else None
+        background = None
+        if cache_file:
+            try:
+                background = np.asarray(Image.open(cache_file).convert('RGB'))
+            except OSError:
+                background = None
+            else:
+                try:
+                    os.utime(cache_file)
+                except FileNotFoundError:
+                    pass
+        if background is None:
+            img_blur = im.convert('RGB').filter(ImageFilter.GaussianBlur(radius=30))
+            if enlarge_background:
+                img_blur = img_blur.resize(size, Image.Resampling.LANCZOS)
+            background = np.asarray(img_blur)
+            if cache_file:
+                tmp_file = cache_file + f'.{os.getpid()}.tmp'
+                img_blur.save(tmp_file, format='PNG')
+                os.replace(tmp_file, cache_file)
+                self.total_bytes += os.path.getsize(cache_file)
+                if self.total_bytes > self.max_bytes:
+                    self.evict()
+
+        self._items[key] = background
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+        return background
+
+    def evict(self):
+        """删除最久未使用的模糊背景，直到总大小降到上限的 90% 以下"""
+        entries = sorted(self._entries())
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+
+_background_caches = {}
+
+def get_background_cache(cache_dir=None):
+    """获取当前进程的模糊背景缓存"""
+    if cache_dir not in _background_caches:
+        _background_caches[cache_dir] = BackgroundCache(cache_dir=cache_dir)
+    return _background_caches[cache_dir]
 
 def load_audio_timing_info(voice_dir):
     """加载音频时长信息"""
@@ -147,128 +437,117 @@ def process_subtitle_ending(subtitle):
     
     return subtitle.strip()
 
-def create_subtitles_from_audio_timing(scenario_index, timing_info, sentence_mapping, max_chars_per_subtitle=20):
-    """根据音频时长信息创建字幕，平均分配显示时间"""
-    audio_key = f"output_{scenario_index}"
-    
-    if audio_key not in timing_info or scenario_index not in sentence_mapping:
-        return []
-    
-    sentence_durations = timing_info[audio_key].get("sentence_durations", [])
-    processed_sentences = sentence_mapping[scenario_index].get("processed_sentences", [])
-    total_duration = timing_info[audio_key].get("total_duration", 0)
-    
-    if not sentence_durations or not processed_sentences or total_duration <= 0:
-        return []
-    
-    # 将所有句子合并成一个完整文本
-    full_text = ''.join(processed_sentences)
-    
-    # 智能分割文本，考虑双引号的情况
-    def smart_split_text(text):
-        """智能分割文本，保护双引号内的内容"""
-        parts = []
-        current_part = ""
-        in_quotes = False
-        quote_chars = ['“', '”']  # 各种引号类型
-        
-        i = 0
-        while i < len(text):
-            char = text[i]
-            
-            # 检查是否遇到引号
-            if char in quote_chars and not in_quotes:
-                in_quotes = True
-                current_part += char
-            elif char in quote_chars and in_quotes:
-                in_quotes = False
-                current_part += char
-            # 如果在引号内，直接添加字符
-            elif in_quotes:
-                current_part += char
-            # 如果不在引号内，检查分割标点
-            elif char in ['，', ',', '。', '！', '？', '；', ';']:
-                current_part += char
-                if current_part.strip():
-                    parts.append(current_part.strip())
-                current_part = ""
-            else:
-                current_part += char
-            
-            i += 1
-        
-        # 添加最后一部分
-        if current_part.strip():
-            parts.append(current_part.strip())
-        
-        return parts
-    
-    text_parts = smart_split_text(full_text)
-    
-    # 智能合并：区分结束标点符号和中间标点符号
+# 以这些标点结尾的字幕不再与后续短句合并
+ENDING_PUNCTUATION = '。！？.!?'
+
+def merge_subtitle_parts(parts, max_chars_per_subtitle=20):
+    """把 (短句, 开始, 结束) 智能合并为不超过 max_chars_per_subtitle 字的字幕
+
+    以结束标点符号结尾的字幕不再合并；单个短句过长时强制拆分，时间按字数比例分配。
+    """
     merged_subtitles = []
     current_subtitle = ""
-    
-    # 定义结束标点符号和中间标点符号
-    ending_punctuation = ['。', '！', '？', '.', '!', '?']
-    middle_punctuation = ['，', ',', '；', ';']
-    
-    for part in text_parts:
-        # 检查当前字幕是否以结束标点符号结尾
-        current_ends_with_ending = current_subtitle and current_subtitle[-1] in ending_punctuation
-        
+    current_start = current_end = 0
+
+    def append_subtitle(text, start_time, end_time):
+        processed_subtitle = process_subtitle_ending(text)
+        if processed_subtitle:  # 确保字幕不为空
+            merged_subtitles.append((processed_subtitle, start_time, end_time))
+
+    for part, part_start, part_end in parts:
         # 如果当前字幕以结束标点符号结尾，不能合并
-        if current_ends_with_ending:
-            # 保存当前字幕
-            processed_subtitle = process_subtitle_ending(current_subtitle)
-            if processed_subtitle:  # 确保字幕不为空
-                merged_subtitles.append(processed_subtitle)
-            current_subtitle = part
-        # 如果当前字幕加上新部分不超过长度限制，且当前字幕不以结束标点符号结尾
+        if current_subtitle and current_subtitle[-1] in ENDING_PUNCTUATION:
+            append_subtitle(current_subtitle, current_start, current_end)
+            current_subtitle, current_start, current_end = part, part_start, part_end
+        # 如果当前字幕加上新部分不超过长度限制
         elif len(current_subtitle + part) <= max_chars_per_subtitle:
+            if not current_subtitle:
+                current_start = part_start
             current_subtitle += part
+            current_end = part_end
         else:
             # 保存当前字幕（如果不为空）
             if current_subtitle:
-                processed_subtitle = process_subtitle_ending(current_subtitle)
-                if processed_subtitle:  # 确保字幕不为空
-                    merged_subtitles.append(processed_subtitle)
+                append_subtitle(current_subtitle, current_start, current_end)
                 current_subtitle = ""
-            
+
             # 如果单个部分太长，需要强制拆分
             if len(part) > max_chars_per_subtitle:
+                char_duration = (part_end - part_start) / len(part)
                 for i in range(0, len(part), max_chars_per_subtitle):
                     chunk = part[i:i + max_chars_per_subtitle]
-                    processed_chunk = process_subtitle_ending(chunk)
-                    if processed_chunk:  # 确保字幕不为空
-                        merged_subtitles.append(processed_chunk)
+                    append_subtitle(chunk, part_start + i * char_duration, part_start + (i + len(chunk)) * char_duration)
             else:
-                current_subtitle = part
-    
+                current_subtitle, current_start, current_end = part, part_start, part_end
+
     # 添加最后的字幕
     if current_subtitle:
-        processed_subtitle = process_subtitle_ending(current_subtitle)
-        if processed_subtitle:  # 确保字幕不为空
-            merged_subtitles.append(processed_subtitle)
+        append_subtitle(current_subtitle, current_start, current_end)
+
+    return merged_subtitles
+
+def sentence_offsets_from_durations(sentence_durations):
+    """旧版 audio_timing.json 只有句子时长，按累计时长推算每个句子的 [开始, 结束]
+
+    段首静音计入第一句。
+    """
+    offsets = []
+    position = 0
+    for duration in sentence_durations:
+        offsets.append([position, position + duration])
+        position += duration
+    return offsets
+
+def create_subtitles_from_audio_timing(scenario_index, timing_info, sentence_mapping, max_chars_per_subtitle=20):
+    """根据 Step 3 记录的句子与短句时间戳创建字幕
+
+    短句数与 Kokoro 给出的短句时间戳一致时直接使用，否则在句子时间范围内按字数分配。
+    """
+    audio_key = f"output_{scenario_index}"
     
-    # 如果没有生成任何字幕，返回空
-    if not merged_subtitles:
+    if audio_key not in timing_info or scenario_index not in sentence_mapping:
         return []
     
-    # 平均分配时间：总时长除以字幕数量
-    subtitle_duration = total_duration / len(merged_subtitles)
-    
-    # 创建字幕列表，每个字幕显示时间相等
-    subtitles = []
-    for i, subtitle_text in enumerate(merged_subtitles):
-        start_time = i * subtitle_duration
-        end_time = (i + 1) * subtitle_duration
-        # 确保最后一个字幕不超过总时长
-        if i == len(merged_subtitles) - 1:
-            end_time = total_duration
-        subtitles.append((subtitle_text, start_time, end_time))
+    entry = timing_info[audio_key]
+    processed_sentences = sentence_mapping[scenario_index].get("processed_sentences", [])
+    total_duration = entry.get("total_duration", 0)
+    sentence_offsets = entry.get("sentence_offsets") or sentence_offsets_from_durations(entry.get("sentence_durations", []))
     
-    return subtitles
+    if not sentence_offsets or not processed_sentences or total_duration <= 0:
+        return []
+    if len(sentence_offsets) != len(processed_sentences):
+        return []
+    phrase_offsets = entry.get("phrase_offsets") or [None] * len(sentence_offsets)
+    
+    # 智能分割每个句子，保护双引号内的内容，并为每个短句确定时间
+    text_parts = []
+    for sentence, (sentence_start, sentence_end), phrases in zip(processed_sentences, sentence_offsets, phrase_offsets):
+        clauses = split_clauses(sentence)
+        if phrases and len(phrases) == len(clauses):
+            text_parts.extend((clause, start, end) for clause, (start, end) in zip(clauses, phrases))
+            continue
+        char_duration = (sentence_end - sentence_start) / max(sum(len(clause) for clause in clauses), 1)
+        position = sentence_start
+        for clause in clauses:
+            text_parts.append((clause, position, position + len(clause) * char_duration))
+            position += len(clause) * char_duration
+    
+    return merge_subtitle_parts(text_parts, max_chars_per_subtitle)
+
+class SubtitleIndex:
+    """按开始时间排序的字幕区间索引，用二分查找取出与某个时间段重叠的字幕"""
+
+    def __init__(self, subtitles):
+        self.subtitles = sorted(subtitles, key=lambda subtitle: subtitle[1])
+        self.starts = [subtitle[1] for subtitle in self.subtitles]
+        # 结束时间的前缀最大值单调不减，字幕之间有重叠时二分查找同样成立
+        self.max_ends = list(itertools.accumulate((subtitle[2] for subtitle in self.subtitles), max))
+
+    def overlapping(self, start_time, end_time):
+        """返回与 [start_time, end_time) 重叠的字幕"""
+        lo = bisect.bisect_right(self.max_ends, start_time)
+        hi = bisect.bisect_left(self.starts, end_time)
+        return [subtitle for subtitle in self.subtitles[lo:hi] if subtitle[2] > start_time]
 
 def split_text_by_time(text, total_duration, subtitle_duration=2.5, max_chars_per_subtitle=20):
     """根据时间切割文本为短字幕，平均分配时间"""
@@ -283,96 +562,16 @@ def split_text_by_time(text, total_duration, subtitle_duration=2.5, max_chars_pe
         processed_text = process_subtitle_ending(text)
         return [(processed_text, 0, total_duration)]
     
-    # 智能分割文本，考虑双引号的情况
-    def smart_split_text(text):
-        """智能分割文本，保护双引号内的内容"""
-        parts = []
-        current_part = ""
-        in_quotes = False
-        quote_chars = ['"', '"', '"', "'", "'"]  # 各种引号类型
-        
-        i = 0
-        while i < len(text):
-            char = text[i]
-            
-            # 检查是否遇到引号
-            if char in quote_chars and not in_quotes:
-                in_quotes = True
-                current_part += char
-            elif char in quote_chars and in_quotes:
-                in_quotes = False
-                current_part += char
-            # 如果在引号内，直接添加字符
-            elif in_quotes:
-                current_part += char
-            # 如果不在引号内，检查分割标点
-            elif char in ['，', ',', '。', '！', '？', '；', ';']:
-                current_part += char
-                if current_part.strip():
-                    parts.append(current_part.strip())
-                current_part = ""
-            else:
-                current_part += char
-            
-            i += 1
-        
-        # 添加最后一部分
-        if current_part.strip():
-            parts.append(current_part.strip())
-        
-        return parts
-    
-    text_parts = smart_split_text(text)
+    # 智能分割文本，保护引号内的内容
+    text_parts = split_clauses(text, quote_chars='"\'')
     
     # 如果没有分割出部分，回退到原始文本
     if not text_parts:
         text_parts = [text]
     
-    # 智能合并：区分结束标点符号和中间标点符号
-    merged_subtitles = []
-    current_subtitle = ""
-    
-    # 定义结束标点符号和中间标点符号
-    ending_punctuation = ['。', '！', '？', '.', '!', '?']
-    middle_punctuation = ['，', ',', '；', ';']
-    
-    for part in text_parts:
-        # 检查当前字幕是否以结束标点符号结尾
-        current_ends_with_ending = current_subtitle and current_subtitle[-1] in ending_punctuation
-        
-        # 如果当前字幕以结束标点符号结尾，不能合并
-        if current_ends_with_ending:
-            # 保存当前字幕
-            processed_subtitle = process_subtitle_ending(current_subtitle)
-            if processed_subtitle:  # 确保字幕不为空
-                merged_subtitles.append(processed_subtitle)
-            current_subtitle = part
-        # 如果当前字幕加上新部分不超过长度限制，且当前字幕不以结束标点符号结尾
-        elif len(current_subtitle + part) <= max_chars_per_subtitle:
-            current_subtitle += part
-        else:
-            # 保存当前字幕（如果不为空）
-            if current_subtitle:
-                processed_subtitle = process_subtitle_ending(current_subtitle)
-                if processed_subtitle:  # 确保字幕不为空
-                    merged_subtitles.append(processed_subtitle)
-                current_subtitle = ""
-            
-            # 如果单个部分太长，需要强制拆分
-            if len(part) > max_chars_per_subtitle:
-                for i in range(0, len(part), max_chars_per_subtitle):
-                    chunk = part[i:i + max_chars_per_subtitle]
-                    processed_chunk = process_subtitle_ending(chunk)
-                    if processed_chunk:  # 确保字幕不为空
-                        merged_subtitles.append(processed_chunk)
-            else:
-                current_subtitle = part
-    
-    # 添加最后的字幕
-    if current_subtitle:
-        processed_subtitle = process_subtitle_ending(current_subtitle)
-        if processed_subtitle:  # 确保字幕不为空
-            merged_subtitles.append(processed_subtitle)
+    # 没有音频时间戳，先合并字幕再平均分配时间
+    merged_subtitles = [subtitle for subtitle, _, _ in merge_subtitle_parts(
+        [(part, 0, 0) for part in text_parts], max_chars_per_subtitle)]
     
     # 如果没有生成任何字幕，至少添加一个
     if not merged_subtitles:
@@ -394,7 +593,204 @@ def split_text_by_time(text, total_duration, subtitle_duration=2.5, max_chars_pe
     
     return subtitles
 
-def main():
+def find_image_path(image_dir, idx, extensions=('.png', '.jpg', '.jpeg')):
+    """查找子图对应的图片文件"""
+    for ext in extensions:
+        img_path = os.path.join(image_dir, f'output_{idx+1}{ext}')
+        if os.path.exists(img_path):
+            return img_path
+    print(f"图像 output_{idx} 未找到，跳过。")
+    return img_path
+
+def hash_file(path, chunk_size=1 << 20):
+    """计算文件内容的 SHA-256"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+def scene_fingerprint(i, scenario, timing_info, sentence_mapping, settings):
+    """计算场景全部输入的内容哈希：子图、音频、字幕来源与相关配置"""
+    h = hashlib.sha256()
+    for idx in scenario['子图索引']:
+        img_path = find_image_path(settings['image_dir'], idx)
+        h.update(f"image:{idx}:".encode('utf-8'))
+        h.update(hash_file(img_path).encode('utf-8') if os.path.exists(img_path) else b'missing')
+    wav_path = os.path.join(settings['voice_dir'], f'output_{i}.wav')
+    h.update(b'audio:')
+    h.update(hash_file(wav_path).encode('utf-8') if os.path.exists(wav_path) else b'missing')
+    # 字幕由这些输入唯一确定
+    subtitle_source = {
+        'content': scenario.get('内容', ''),
+        'timing': timing_info.get(f'output_{i}'),
+        'sentences': sentence_mapping.get(i),
+    }
+    h.update(json.dumps(subtitle_source, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+    render_config = {
+        key: settings[key]
+        for key in ('fps', 'enlarge_background', 'enable_effect', 'effect_type', 'intermediate_profile')
+    }
+    h.update(json.dumps(render_config, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+def load_manifest(manifest_file):
+    """读取上次渲染记录的场景哈希"""
+    if os.path.exists(manifest_file):
+        try:
+            with open(manifest_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            pass
+    return {}
+
+def save_manifest(manifest_file, manifest):
+    """原子地写入场景哈希记录"""
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_file, manifest_file)
+
+def render_scene(i, scenario, timing_info, sentence_mapping, settings):
+    """渲染单个场景到 temp/output_{i}.mp4，返回 (场景索引, 文件路径, 用时)
+
+    只依赖本场景的图片、音频与时长信息，可以在子进程中独立执行。
+    """
+    start = time.perf_counter()
+    fps = settings['fps']
+    enlarge_background = settings['enlarge_background']
+    # 每个场景独立的随机数，子进程不会因继承同一随机状态而重复相同的运镜
+    rng = random.Random(f"{settings['effect_seed']}-{i}")
+
+    im_indices = scenario['子图索引']
+    audio_filename = os.path.join(settings['voice_dir'], f'output_{i}')
+    temp_filename = os.path.join(settings['temp_dir'], f'output_{i}.mp4')
+
+    audio = AudioFileClip(audio_filename + '.wav')
+
+    # 使用音频时长信息创建精确对齐的字幕（增加字幕长度）
+    subtitle_list = create_subtitles_from_audio_timing(i, timing_info, sentence_mapping, max_chars_per_subtitle=23)
+
+    # 如果没有获取到时长信息，回退到原方法（同样增加字幕长度）
+    if not subtitle_list:
+        subtitle_text = scenario.get('内容', '')
+        subtitle_list = split_text_by_time(subtitle_text, audio.duration, subtitle_duration=2.5, max_chars_per_subtitle=23)
+
+    subtitle_index = SubtitleIndex(subtitle_list)
+
+    segment_duration = audio.duration / len(im_indices)
+    segment_frames = int(segment_duration * fps)
+    all_segments = []
+
+    for idx_num, idx in enumerate(im_indices):
+        img_path = find_image_path(settings['image_dir'], idx)
+
+        im = Image.open(img_path)
+        effect_type = rng.choice([0, 1])
+
+        if effect_type == 0:
+            x_speed = (im.width - im.width * 0.8) / segment_duration
+            y_speed = 0
+            move_on_x = True
+        elif effect_type == 1:
+            x_speed = 0
+            y_speed = (im.height - im.height * 0.8) / segment_duration
+            move_on_x = False
+        move_positive = rng.choice([True, False])
+        renderer = KenBurnsRenderer(im)
+        windows = renderer.crop_windows(segment_frames, fps, x_speed, y_speed, move_on_x, move_positive)
+
+        background = get_background_cache(settings.get('cache_dir')).get(img_path, im, enlarge_background)
+        bg_height, bg_width = background.shape[:2]
+
+        # 为当前时间段添加相应的字幕
+        segment_start_time = idx_num * segment_duration
+        segment_end_time = (idx_num + 1) * segment_duration
+
+        # 收集在当前时间段内的字幕
+        current_subtitles = []
+        for subtitle_text, start_time, end_time in subtitle_index.overlapping(segment_start_time, segment_end_time):
+            # 计算在当前段内的显示时间
+            display_start = max(0, start_time - segment_start_time)
+            display_end = min(segment_duration, end_time - segment_start_time)
+            current_subtitles.append((subtitle_text, display_start, display_end))
+
+        # 创建字幕图层
+        subtitle_layers = []
+        for subtitle_text, display_start, display_end in current_subtitles:
+            # 不足一帧的字幕不显示
+            if int(display_end * fps) > int(display_start * fps):
+                tile, position = render_subtitle_tile(subtitle_text, bg_width, bg_height)
+                subtitle_layers.append((tile, position, display_start, display_end))
+
+        frame_source = SegmentFrameSource(
+            renderer, windows, background, subtitle_layers, fps)
+        segment_clip = frame_source.to_clip()
+
+        all_segments.append(segment_clip)
+
+    final_clip = concatenate_videoclips(all_segments, method="compose").set_audio(audio)
+    final_clip.write_videofile(
+        temp_filename,
+        logger=settings.get('logger', 'bar'),
+        **write_videofile_args(settings['intermediate_profile'], final_clip.size),
+    )
+    final_clip.close()
+    audio.close()
+    gc.collect()
+
+    return i, temp_filename, time.perf_counter() - start
+
+def probe_clip_params(filename):
+    """读取视频的尺寸、帧率与音频采样率，用于判断能否直接拼接"""
+    infos = ffmpeg_parse_infos(filename)
+    return (
+        tuple(infos.get('video_size') or ()),
+        infos.get('video_fps'),
+        infos.get('audio_found'),
+        infos.get('audio_fps'),
+    )
+
+def concat_scene_clips(temp_filenames, output_filename, delivery_profile=None):
+    """拼接场景视频
+
+    所有场景参数一致时使用 ffmpeg concat demuxer 拼接：未指定 delivery_profile 时
+    直接复制码流，否则按该导出配置一次性编码；参数不一致或 ffmpeg 失败时回退到 moviepy 重新编码。
+    """
+    if len({probe_clip_params(filename) for filename in temp_filenames}) == 1:
+        list_file = os.path.join(os.path.dirname(output_filename), 'concat_list.txt')
+        with open(list_file, 'w', encoding='utf-8') as f:
+            for filename in temp_filenames:
+                path = os.path.abspath(filename).replace('\\', '/').replace("'", "'\\''")
+                f.write(f"file '{path}'\n")
+        cmd = [
+            get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error',
+            '-f', 'concat', '-safe', '0', '-i', list_file,
+            *(['-c', 'copy'] if delivery_profile is None else ffmpeg_encode_args(delivery_profile)),
+            '-movflags', '+faststart',
+            output_filename,
+        ]
+        try:
+            subprocess.run(cmd, check=True, capture_output=True)
+            return output_filename
+        except subprocess.CalledProcessError as e:
+            print(f"直接拼接失败，改为重新编码: {e.stderr.decode('utf-8', errors='ignore')}")
+        finally:
+            os.remove(list_file)
+    else:
+        print("场景视频参数不一致，改为重新编码拼接")
+
+    clips = [VideoFileClip(filename) for filename in temp_filenames]
+    final_video = concatenate_videoclips(clips, method="compose")
+    final_video.write_videofile(
+        output_filename,
+        **write_videofile_args(delivery_profile or DEFAULT_EXPORT_PROFILES['delivery'], final_video.size),
+    )
+    for clip in clips:
+        clip.close()
+    return output_filename
+
+def main(workers=None, force=False):
 
     print("BADAPPLE")
 
@@ -414,119 +810,79 @@ def main():
     os.makedirs(temp_dir, exist_ok=True)
 
     total_files = len(scenario_info)
-    fps = config['fps']
-    enlarge_background = config['enlarge_background']
-    enable_effect = config['enable_effect']
-    effect_type = config['effect_type']
+    if workers is None:
+        workers = config.get('render_workers', 1)
+    workers = max(1, min(int(workers), total_files or 1))
+
+    settings = {
+        'fps': config['fps'],
+        'enlarge_background': config['enlarge_background'],
+        'enable_effect': config['enable_effect'],
+        'effect_type': config['effect_type'],
+        'image_dir': image_dir,
+        'voice_dir': voice_dir,
+        'temp_dir': temp_dir,
+        'cache_dir': os.path.join(temp_dir, 'step4_cache') if config.get('step4_disk_cache', True) else None,
+        'intermediate_profile': get_export_profile(config, config.get('intermediate_profile', 'delivery')),
+        # 本次运行的运镜随机种子，各场景在此基础上派生
+        'effect_seed': random.getrandbits(32),
+    }
+    delivery_profile = get_export_profile(config, config.get('delivery_profile', 'delivery'))
 
-    extensions = ['.png', '.jpg', '.jpeg']
     # 加载音频时长信息
     timing_info, sentence_mapping = load_audio_timing_info(voice_dir)
-    # 在主循环中修改字幕长度限制
-    for i in tqdm(range(total_files), ncols=None, desc="正在生成视频"):
-        im_indices = scenario_info[i]['子图索引']
-        audio_filename = os.path.join(voice_dir, f'output_{i}')
-        temp_filename = os.path.join(temp_dir, f'output_{i}.mp4')
-
-        audio = AudioFileClip(audio_filename + '.wav')
-
-        # 使用音频时长信息创建精确对齐的字幕（增加字幕长度）
-        subtitle_list = create_subtitles_from_audio_timing(i, timing_info, sentence_mapping, max_chars_per_subtitle=23)
-
-        # 如果没有获取到时长信息，回退到原方法（同样增加字幕长度）
-        if not subtitle_list:
-            subtitle_text = scenario_info[i].get('内容', '')
-            subtitle_list = split_text_by_time(subtitle_text, audio.duration, subtitle_duration=2.5, max_chars_per_subtitle=23)
-
-        segment_duration = audio.duration / len(im_indices)
-        segment_frames = int(segment_duration * fps)
-        all_segments = []
+    temp_filenames = [os.path.join(temp_dir, f'output_{i}.mp4') for i in range(total_files)]
 
-        for idx_num, idx in enumerate(im_indices):
-            for ext in extensions:
-                try:
-                    img_path = os.path.join(image_dir, f'output_{idx+1}{ext}')
-                    if os.path.exists(img_path):
-                        break
-                except FileNotFoundError:
-                    print(f"图像 output_{idx} 未找到，跳过。")
-                    continue
-
-            im = Image.open(img_path)
-            effect_type = random.choice([0, 1])
-
-            if effect_type == 0:
-                x_speed = (im.width - im.width * 0.8) / segment_duration
-                y_speed = 0
-                move_on_x = True
-            elif effect_type == 1:
-                x_speed = 0
-                y_speed = (im.height - im.height * 0.8) / segment_duration
-                move_on_x = False
-            move_positive = random.choice([True, False])
-            frames_foreground = [
-                np.array(transform_image(im, t / fps, x_speed, y_speed, move_on_x, move_positive)) 
-                for t in range(segment_frames)
+    # 只重新渲染输入发生变化的场景
+    manifest_file = os.path.join(temp_dir, 'step4_manifest.json')
+    manifest = {} if force else load_manifest(manifest_file)
+    fingerprints = {}
+    pending = []
+    for i in range(total_files):
+        fingerprints[i] = scene_fingerprint(i, scenario_info[i], timing_info, sentence_mapping, settings)
+        if manifest.get(f'output_{i}') == fingerprints[i] and os.path.exists(temp_filenames[i]):
+            continue
+        pending.append(i)
+    if len(pending) < total_files:
+        print(f"{total_files - len(pending)} 个场景未发生变化，跳过渲染")
+
+    def on_scene_done(i, elapsed):
+        manifest[f'output_{i}'] = fingerprints[i]
+        save_manifest(manifest_file, manifest)
+        tqdm.write(f"场景 {i} 渲染完成，用时 {elapsed:.1f}s")
+
+    workers = min(workers, len(pending) or 1)
+    # 多进程渲染时关闭 moviepy 进度条，避免输出交错
+    settings['logger'] = 'bar' if workers == 1 else None
+    if workers == 1:
+        for i in tqdm(pending, ncols=None, desc="正在生成视频"):
+            _, _, elapsed = render_scene(i, scenario_info[i], timing_info, sentence_mapping, settings)
+            on_scene_done(i, elapsed)
+    else:
+        print(f"使用 {workers} 个进程并行渲染 {len(pending)} 个场景")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(render_scene, i, scenario_info[i], timing_info, sentence_mapping, settings)
+                for i in pending
             ]
-            img_foreground = ImageSequenceClip(frames_foreground, fps=fps)
-
-            img_blur = im.filter(ImageFilter.GaussianBlur(radius=30))
-            if enlarge_background:
-                 img_blur = img_blur.resize(
-                    (int(im.width * 1.1), int(im.height * 1.1)), Image.Resampling.LANCZOS)
-            frames_background = [np.array(img_blur)] * segment_frames
-            img_background = ImageSequenceClip(frames_background, fps=fps)
-
-            segment_clip = CompositeVideoClip(
-                [img_background.set_position("center"), img_foreground.set_position("center")], 
-                size=img_blur.size
-            )
-
-            # 为当前时间段添加相应的字幕
-            segment_start_time = idx_num * segment_duration
-            segment_end_time = (idx_num + 1) * segment_duration
-
-            # 收集在当前时间段内的字幕
-            current_subtitles = []
-            for subtitle_text, start_time, end_time in subtitle_list:
-                # 检查字幕时间是否与当前段重叠
-                if not (end_time <= segment_start_time or start_time >= segment_end_time):
-                    # 计算在当前段内的显示时间
-                    display_start = max(0, start_time - segment_start_time)
-                    display_end = min(segment_duration, end_time - segment_start_time)
-                    current_subtitles.append((subtitle_text, display_start, display_end))
-
-            # 创建字幕图层
-            if current_subtitles:
-                subtitle_clips = []
-                for subtitle_text, display_start, display_end in current_subtitles:
-                    subtitle_img = create_subtitle_image(subtitle_text, img_blur.size[0], img_blur.size[1])
-
-                    # 计算需要显示的帧数
-                    start_frame = int(display_start * fps)
-                    end_frame = int(display_end * fps)
-                    subtitle_frames = [subtitle_img] * (end_frame - start_frame)
-
-                    if subtitle_frames:
-                        subtitle_clip = ImageSequenceClip(subtitle_frames, fps=fps)
-                        subtitle_clip = subtitle_clip.set_start(display_start)
-                        subtitle_clips.append(subtitle_clip)
-
-                # 如果有字幕，添加到视频中
-                if subtitle_clips:
-                    segment_clip = CompositeVideoClip([segment_clip] + subtitle_clips)
-
-            all_segments.append(segment_clip)
-
-        final_clip = concatenate_videoclips(all_segments, method="compose").set_audio(audio)
-        final_clip.write_videofile(temp_filename)
-        gc.collect()
-
-    temp_filenames = [os.path.join(temp_dir, f'output_{i}.mp4') for i in range(total_files)]
-    temp_filenames.sort(key=lambda x: int(x.split('_')[-1].split('.')[0]))
-    final_video = concatenate_videoclips([VideoFileClip(filename) for filename in temp_filenames], method="compose")
-    final_video.write_videofile(os.path.join(video_dir, f'output_{datetime.now().strftime("%Y%m%d%H%M%S")}.mp4'))
+            with tqdm(total=len(pending), ncols=None, desc="正在生成视频") as pbar:
+                for future in concurrent.futures.as_completed(futures):
+                    i, _, elapsed = future.result()
+                    on_scene_done(i, elapsed)
+                    pbar.update(1)
+
+    os.makedirs(video_dir, exist_ok=True)
+    output_filename = os.path.join(video_dir, f'output_{datetime.now().strftime("%Y%m%d%H%M%S")}.mp4')
+    # 场景视频已按最终配置编码时直接复制码流，否则按 delivery 配置编码一次
+    if delivery_profile == settings['intermediate_profile']:
+        concat_scene_clips(temp_filenames, output_filename)
+    else:
+        concat_scene_clips(temp_filenames, output_filename, delivery_profile)
     
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="合成最终视频")
+    parser.add_argument('--workers', type=int, default=None, help="并行渲染场景的进程数（默认读取 config.json 中的 render_workers）")
+    parser.add_argument('--force', action='store_true', help="忽略渲染记录，重新渲染全部场景")
+    args = parser.parse_args()
+    main(workers=args.workers, force=args.force)
     print("🎉 视频生成完成！")